@@ -0,0 +1,270 @@
+"""
+بنچمارک سرتاسری تصحیح ارسال‌ها و اجرای کوئری‌های سرکلاسی.
+
+یک دیتابیس محلی (Postgres از طریق BENCH_DB_URI یا به طور پیش‌فرض SQLite) با
+داده مصنوعی، جدول‌های مرجع و مجموعه‌ای از ارسال‌های درست، نادرست و پرهزینه پر
+می‌شود و process_sql و process_classroom_sql مستقیماً با Update و
+CallbackContext ساختگی فراخوانی می‌شوند.
+
+نمونه اجرا:
+    python bench_grading.py --submissions 500 --reference-rows 2000 --concurrency 8
+"""
+import os
+import sys
+import random
+import resource
+import argparse
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_HW = "99"
+BENCH_MAJOR = "علوم کامپیوتر"
+BENCH_TABLE = "bench_data"
+
+
+def _default_db_uri():
+    path = os.path.join(tempfile.gettempdir(), "telegram_bot_bench.db")
+    return f"sqlite:///{path}?check_same_thread=false&timeout=60"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="بنچمارک تصحیح ارسال‌ها")
+    parser.add_argument("--db-uri", default=os.environ.get("BENCH_DB_URI") or _default_db_uri())
+    parser.add_argument("--mode", choices=["grading", "classroom", "both"], default="both")
+    parser.add_argument("--submissions", type=int, default=200, help="تعداد ارسال‌ها (یا کوئری‌های سرکلاسی)")
+    parser.add_argument("--questions", type=int, default=6, help="تعداد سوال هر ارسال")
+    parser.add_argument("--reference-rows", type=int, default=1000, help="تعداد ردیف جدول داده")
+    parser.add_argument("--pathological-ratio", type=float, default=0.05, help="سهم کوئری‌های پرهزینه (cross join)")
+    parser.add_argument("--incorrect-ratio", type=float, default=0.3, help="سهم کوئری‌های نادرست")
+    parser.add_argument("--concurrency", type=int, default=1, help="تعداد ارسال‌های هم‌زمان")
+    parser.add_argument("--memo", action="store_true",
+                        help="فعال کردن کش ارسال‌های تکراری (به طور پیش‌فرض خاموش است تا خود تصحیح اندازه‌گیری شود)")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0,
+                        help="سهم سوال‌هایی که متنشان با ارسال‌های دیگر یکسان است؛ بقیه برای هر ارسال متن یکتا دارند")
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default="threads",
+                        help="asyncio با SQLite به بسته aiosqlite نیاز دارد")
+    parser.add_argument("--seed", type=int, default=1405)
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# main.py در زمان import این متغیرها را لازم دارد
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ.setdefault("ADMIN_CHAT_ID", "0")
+os.environ["DB_URI"] = args.db_uri
+# تصحیح و کوئری‌های سرکلاسی روی CLASSROOM_DB_URI اجرا می‌شوند و باید همان دیتابیس بنچمارک باشند
+os.environ["CLASSROOM_DB_URI"] = args.db_uri
+
+import main  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+
+# ==================== اشیای ساختگی تلگرام ====================
+
+class FakeMessage:
+    def __init__(self, chat_id, text=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.replies = []
+
+    def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeUpdate:
+    def __init__(self, chat_id, text=None):
+        self.message = FakeMessage(chat_id, text)
+        self.effective_chat = FakeChat(chat_id)
+
+
+class FakeBot:
+    def send_message(self, chat_id, text, **kwargs):
+        pass
+
+
+class FakeContext:
+    def __init__(self, user_data):
+        self.user_data = user_data
+        self.args = []
+        self.bot = FakeBot()
+
+
+# ==================== آماده‌سازی داده ====================
+
+def _threshold(question_number):
+    return 5 + question_number
+
+
+def seed_database(rng):
+    if main.engine.dialect.name == "postgresql":
+        main.run_migrations()
+    else:
+        # مهاجرت‌ها مخصوص Postgres هستند؛ برای SQLite فقط جدول نتایج ساخته می‌شود
+        with main.engine.begin() as conn:
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")  # خواندن‌های هم‌زمان نوشتن نتایج را قفل نمی‌کنند
+            conn.exec_driver_sql("DROP TABLE IF EXISTS student_results")
+            conn.exec_driver_sql("""
+                CREATE TABLE student_results (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    student_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    major TEXT NOT NULL,
+                    hw TEXT NOT NULL,
+                    correct_count INTEGER NOT NULL,
+                    sql_queries TEXT NOT NULL,
+                    question_outcomes TEXT,
+                    submission_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    submission_uid TEXT UNIQUE
+                )
+            """)
+            conn.exec_driver_sql("""
+                CREATE TABLE IF NOT EXISTS submission_counters (
+                    student_id TEXT NOT NULL,
+                    hw TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (student_id, hw)
+                )
+            """)
+    with main.engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {BENCH_TABLE}"))
+        conn.execute(text(f"CREATE TABLE {BENCH_TABLE} (id INTEGER PRIMARY KEY, name TEXT, grade INTEGER)"))
+        conn.execute(
+            text(f"INSERT INTO {BENCH_TABLE} (id, name, grade) VALUES (:id, :name, :grade)"),
+            [{"id": i, "name": f"student {i}", "grade": rng.randint(0, 20)} for i in range(args.reference_rows)]
+        )
+        for question_number in range(1, args.questions + 1):
+            reference_table = main.get_reference_table(BENCH_HW, question_number, BENCH_MAJOR)
+            conn.execute(text(f"DROP TABLE IF EXISTS {reference_table}"))
+            conn.execute(text(
+                f"CREATE TABLE {reference_table} AS "
+                f"SELECT id, name, grade FROM {BENCH_TABLE} WHERE grade >= {_threshold(question_number)}"
+            ))
+        conn.execute(text("CREATE TABLE IF NOT EXISTS allowed_tables (table_name TEXT)"))
+        conn.execute(text("DELETE FROM allowed_tables WHERE table_name = :table_name"), {"table_name": BENCH_TABLE})
+        conn.execute(text("INSERT INTO allowed_tables (table_name) VALUES (:table_name)"), {"table_name": BENCH_TABLE})
+    try:
+        with main.engine.begin() as conn:
+            conn.execute(text("DELETE FROM student_results WHERE student_id LIKE 'bench-%'"))
+            conn.execute(text("DELETE FROM submission_counters WHERE student_id LIKE 'bench-%'"))
+    except Exception:
+        pass
+
+
+def make_query(rng, question_number, tag=None):
+    """tag شرط همیشه‌درستی اضافه می‌کند که نتیجه را تغییر نمی‌دهد ولی کلید کش ارسال‌ها را یکتا می‌کند"""
+    condition = f"{tag} = {tag}" if tag is not None else None
+    roll = rng.random()
+    if roll < args.pathological_ratio:
+        where = f" WHERE {condition}" if condition else ""
+        return f"SELECT a.id, b.name FROM {BENCH_TABLE} a CROSS JOIN {BENCH_TABLE} b{where};"
+    extra = f" AND {condition}" if condition else ""
+    if roll < args.pathological_ratio + args.incorrect_ratio:
+        return f"SELECT id, name, grade FROM {BENCH_TABLE} WHERE grade > {_threshold(question_number)}{extra};"
+    return f"SELECT id, name, grade\nFROM {BENCH_TABLE}\nWHERE grade >= {_threshold(question_number)}{extra};"
+
+
+def make_submission(rng, submission_index):
+    return "\n\n".join(
+        f"-- #{question_number}\n"
+        f"{make_query(rng, question_number, None if rng.random() < args.duplicate_ratio else submission_index)}"
+        for question_number in range(1, args.questions + 1)
+    )
+
+
+# ==================== اجرای بنچمارک ====================
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_workload(name, jobs):
+    latencies = []
+
+    def timed(job):
+        started = time.perf_counter()
+        job()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = sorted(executor.map(timed, jobs))
+    elapsed = time.perf_counter() - started
+
+    print(f"\n{name}: {len(latencies)} runs, concurrency {args.concurrency}, runtime {args.runtime}, "
+          f"memo {'on' if args.memo else 'off'}, duplicate ratio {args.duplicate_ratio}")
+    print(f"  throughput: {len(latencies) / elapsed:.1f}/s")
+    for label, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+        print(f"  {label}: {_percentile(latencies, fraction) * 1000:.1f} ms")
+
+
+def grading_jobs(rng):
+    jobs = []
+    for i in range(args.submissions):
+        # هر دانشجو حداکثر ۹ بار ارسال می‌کند تا به سقف ۱۰ ارسال نرسد
+        student_id = f"bench-{i // 9}"
+        submission = {"hw": BENCH_HW, "name": f"Bench {student_id}", "student_id": student_id, "major": BENCH_MAJOR}
+        sql_text = make_submission(rng, i)
+        update = FakeUpdate(chat_id=i)
+        context = FakeContext(dict(submission))
+        if args.runtime == "asyncio":
+            jobs.append(lambda update=update, context=context, sql_text=sql_text, submission=submission:
+                        main.async_runtime.submit(main.async_process_sql(update, context, sql_text, submission)).result())
+        else:
+            jobs.append(lambda update=update, context=context, sql_text=sql_text, submission=submission:
+                        main.process_sql(update, context, sql_text, submission))
+    return jobs
+
+
+def classroom_jobs(rng):
+    jobs = []
+    for i in range(args.submissions):
+        sql_text = make_query(rng, rng.randint(1, args.questions))
+        update = FakeUpdate(chat_id=i, text=sql_text)
+        context = FakeContext({"hw": BENCH_HW, "name": "Bench", "student_id": f"bench-{i}", "major": BENCH_MAJOR})
+        if args.runtime == "asyncio":
+            jobs.append(lambda update=update, context=context, sql_text=sql_text:
+                        main.async_runtime.submit(main.async_process_classroom_sql(update, context, sql_text)).result())
+        else:
+            jobs.append(lambda update=update, context=context, sql_text=sql_text:
+                        main.process_classroom_sql(update, context, sql_text))
+    return jobs
+
+
+def main_bench():
+    rng = random.Random(args.seed)
+    if not args.memo:
+        main.submission_memo.max_size = 0
+    print(f"Seeding {args.db_uri} with {args.reference_rows} rows and {args.questions} reference tables...")
+    seed_database(rng)
+    main.result_writer.start()
+    if args.runtime == "asyncio":
+        main.async_runtime.start()
+
+    if args.mode in ("grading", "both"):
+        run_workload("process_sql", grading_jobs(rng))
+        started = time.perf_counter()
+        main.result_writer.flush()
+        print(f"  write-behind flush: {(time.perf_counter() - started) * 1000:.1f} ms")
+        print(f"  reference cache: {main.reference_cache.hits} hits / {main.reference_cache.misses} misses")
+        print(f"  submission memo: {main.submission_memo.hits} hits / {main.submission_memo.misses} misses")
+    if args.mode in ("classroom", "both"):
+        run_workload("process_classroom_sql", classroom_jobs(rng))
+
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss_kb //= 1024
+    print(f"\npeak RSS: {peak_rss_kb / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main_bench()
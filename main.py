@@ -1,12 +1,37 @@
 
 import os
 import re
+import argparse
+import select
 import json
+import hashlib
+import hmac
+import secrets
+import asyncio
+import heapq
+import itertools
+import uuid
+import codecs
+import fcntl
+import glob
+import urllib.request
+from functools import partial, wraps
+from decimal import Decimal
+from contextlib import contextmanager
+from collections import OrderedDict, Counter, deque
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, Document
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
-from sqlalchemy import create_engine, text
-from flask import Flask
-from threading import Thread
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, ExtBot
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
+from sqlalchemy import create_engine, text, make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool, QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.exc import TimeoutError as SQLAlchemyTimeoutError, OperationalError
+from flask import Flask, request
+from threading import Thread, Lock, BoundedSemaphore, Condition, local
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, as_completed, FIRST_COMPLETED
+from queue import Queue, Full
+import time
 import jdatetime
 from datetime import datetime
 import pytz
@@ -16,12 +41,141 @@ import pytz
 TOKEN = os.environ.get("BOT_TOKEN")
 DB_URI = os.environ.get("DB_URI")
 ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID")  # شناسه کاربری ادمین
+# replica یا نقش فقط‌خواندنی برای اجرای کوئری‌های دانشجو؛ در صورت تنظیم نشدن همان DB_URI
+CLASSROOM_DB_URI = os.environ.get("CLASSROOM_DB_URI") or DB_URI
 
 if not TOKEN or not DB_URI or not ADMIN_CHAT_ID:
     raise ValueError("BOT_TOKEN, DB_URI and ADMIN_CHAT_ID must be set!")
 
-engine = create_engine(DB_URI, pool_pre_ping=True)
-user_state = {}
+MAX_SUBMISSIONS = 10  # حداکثر تعداد ارسال هر دانشجو برای هر تمرین
+
+# ==================== Pool اتصال‌ها ====================
+
+# مرزهای هیستوگرام زمان انتظار برای گرفتن اتصال (ثانیه)
+POOL_WAIT_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# همه engineهای ساخته‌شده برای گزارش /pool_stats
+pooled_engines = []
+
+class PoolMetrics:
+    """آمار زمان انتظار برای گرفتن اتصال از یک pool"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.wait_counts = [0] * (len(POOL_WAIT_BUCKETS) + 1)
+        self.total_waits = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+        self._lock = Lock()
+
+    def observe_wait(self, seconds: float, timed_out: bool = False):
+        bucket = next((i for i, bound in enumerate(POOL_WAIT_BUCKETS) if seconds <= bound), len(POOL_WAIT_BUCKETS))
+        with self._lock:
+            self.wait_counts[bucket] += 1
+            self.total_waits += 1
+            self.total_wait_time += seconds
+            self.max_wait_time = max(self.max_wait_time, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool که زمان انتظار هر درخواست اتصال را در PoolMetrics ثبت می‌کند"""
+    metrics = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except SQLAlchemyTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_wait(time.perf_counter() - started, timed_out)
+
+    def recreate(self):
+        new_pool = super().recreate()
+        new_pool.metrics = self.metrics
+        return new_pool
+
+class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    """نسخه asyncio همان pool برای engineهای asyncpg"""
+
+def _pool_setting(pool_name: str, setting: str, default: str) -> int:
+    """تنظیم pool از {POOL}_DB_POOL_{SETTING} و در صورت نبود از DB_POOL_{SETTING} خوانده می‌شود"""
+    return int(os.environ.get(f"{pool_name}_DB_POOL_{setting}") or os.environ.get(f"DB_POOL_{setting}") or default)
+
+def create_pooled_engine(pool_name: str, uri: str):
+    """یک engine با pool قابل تنظیم از متغیرهای محیطی و آمار زمان انتظار می‌سازد"""
+    pooled_engine = create_engine(
+        uri,
+        pool_pre_ping=True,
+        poolclass=InstrumentedQueuePool,
+        pool_size=_pool_setting(pool_name, "SIZE", "5"),
+        max_overflow=_pool_setting(pool_name, "MAX_OVERFLOW", "10"),
+        pool_recycle=_pool_setting(pool_name, "RECYCLE", "1800"),
+        pool_timeout=_pool_setting(pool_name, "TIMEOUT", "30"),
+    )
+    pooled_engine.pool.metrics = PoolMetrics(pool_name.lower())
+    pooled_engines.append(pooled_engine)
+    return pooled_engine
+
+# درایور async معادل هر دیتابیس
+_ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+def to_async_uri(uri: str):
+    """آدرس دیتابیس را به آدرس معادل با درایور async تبدیل می‌کند"""
+    url = make_url(uri)
+    url = url.set(drivername=_ASYNC_DRIVERS[url.get_backend_name()])
+    if "sslmode" in url.query:
+        # asyncpg به جای sslmode پارامتر ssl را می‌پذیرد
+        url = url.update_query_dict({"ssl": url.query["sslmode"]}).difference_update_query(["sslmode"])
+    return url
+
+def create_async_pooled_engine(pool_name: str, uri: str):
+    """معادل create_pooled_engine با درایور async؛ همان متغیرهای محیطی pool را می‌خواند"""
+    pooled_engine = create_async_engine(
+        to_async_uri(uri),
+        pool_pre_ping=True,
+        poolclass=InstrumentedAsyncQueuePool,
+        pool_size=_pool_setting(pool_name, "SIZE", "5"),
+        max_overflow=_pool_setting(pool_name, "MAX_OVERFLOW", "10"),
+        pool_recycle=_pool_setting(pool_name, "RECYCLE", "1800"),
+        pool_timeout=_pool_setting(pool_name, "TIMEOUT", "30"),
+    )
+    pooled_engine.pool.metrics = PoolMetrics(f"{pool_name.lower()}_async")
+    pooled_engines.append(pooled_engine.sync_engine)
+    return pooled_engine
+
+# ثبت‌نام، پروفایل، ذخیره نتایج و هر نوشتن دیگری روی دیتابیس اصلی
+engine = create_pooled_engine("BOOKKEEPING", DB_URI)
+# اجرای کوئری‌های دانشجو و خواندن جدول‌های مرجع هنگام تصحیح تمرین (فقط خواندن)
+grading_engine = create_pooled_engine("GRADING", CLASSROOM_DB_URI)
+# اجرای کوئری‌های تمرین‌های سرکلاسی (فقط خواندن)
+classroom_engine = create_pooled_engine("CLASSROOM", CLASSROOM_DB_URI)
+
+def get_pool_stats() -> dict:
+    """وضعیت لحظه‌ای و آمار انتظار همه poolها را برمی‌گرداند"""
+    stats = {}
+    for pooled_engine in pooled_engines:
+        pool = pooled_engine.pool
+        metrics = pool.metrics
+        stats[metrics.name] = {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "waits": metrics.total_waits,
+            "timeouts": metrics.timeouts,
+            "avg_wait_ms": 1000 * metrics.total_wait_time / metrics.total_waits if metrics.total_waits else 0.0,
+            "max_wait_ms": 1000 * metrics.max_wait_time,
+            "wait_histogram": dict(zip([f"<={bound}s" for bound in POOL_WAIT_BUCKETS] + ["inf"], metrics.wait_counts)),
+        }
+    return stats
+
+# ==================== توابع کمکی ====================
 
 welcome_text = (
     "🎓 خوش آمدید به ربات پایگاه داده! 🎓\n\n"
@@ -52,15 +206,48 @@ welcome_text = (
     "━━━━━━━━━━━━━━━━━━━━━━━━━━━"
 )
 
-def get_allowed_tables():
-    """لیست جدول‌های مجاز را از دیتابیس دریافت می‌کند"""
-    try:
-        with engine.begin() as conn:
-            result = conn.execute(text("SELECT table_name FROM allowed_tables"))
-            return [row[0] for row in result.fetchall()]
-    except Exception as e:
-        print(f"Error getting allowed tables: {e}")
-        return ['test']  # جدول پیش‌فرض در صورت بروز خطا
+ALLOWED_TABLES_TTL = int(os.environ.get("ALLOWED_TABLES_TTL", "300"))
+
+class AllowedTablesRegistry:
+    """
+    لیست جدول‌های مجاز در حافظه؛ هنگام راه‌اندازی بارگذاری می‌شود، با اعلان
+    allowed_tables_changed از Postgres به‌روز می‌شود و بعد از ALLOWED_TABLES_TTL ثانیه
+    هم برای اطمینان دوباره خوانده می‌شود.
+    """
+
+    def __init__(self):
+        self.tables = None
+        self._expires_at = 0.0
+        self._lock = Lock()
+
+    def refresh(self):
+        try:
+            with engine.begin() as conn:
+                result = conn.execute(text("SELECT table_name FROM allowed_tables"))
+                tables = frozenset(row[0] for row in result.fetchall())
+        except Exception as e:
+            print(f"Error getting allowed tables: {e}")
+            with self._lock:
+                if self.tables is None:
+                    return frozenset(['test'])  # جدول پیش‌فرض اگر دیتابیس در اولین بارگذاری در دسترس نباشد
+                # تا TTL بعدی از آخرین لیست معتبر استفاده می‌شود
+                self._expires_at = time.monotonic() + ALLOWED_TABLES_TTL
+                return self.tables
+        with self._lock:
+            self.tables = tables
+            self._expires_at = time.monotonic() + ALLOWED_TABLES_TTL
+        return tables
+
+    def get(self) -> frozenset:
+        if self.tables is None or self._expires_at < time.monotonic():
+            return self.refresh()
+        return self.tables
+
+allowed_tables_registry = AllowedTablesRegistry()
+
+def get_allowed_tables() -> frozenset:
+    """مجموعه جدول‌های مجاز را از حافظه برمی‌گرداند"""
+    return allowed_tables_registry.get()
 
 def get_persian_datetime():
     """تاریخ و ساعت فعلی را به وقت تهران و به فارسی برمی‌گرداند"""
@@ -134,12 +321,6 @@ def update_email(student_id: str, new_email: str):
     """ایمیل دانشجو را به‌روزرسانی می‌کند و تاریخ تغییر را ثبت می‌کند"""
     try:
         with engine.begin() as conn:
-            try:
-                conn.execute(text("ALTER TABLE stuid ADD COLUMN IF NOT EXISTS email_history TEXT"))
-            except Exception as alter_error:
-                print(f"Note: email_history column may already exist: {alter_error}")
-                pass
-            
             result = conn.execute(
                 text("SELECT email, email_history FROM stuid WHERE student_id = :student_id"),
                 {"student_id": student_id}
@@ -156,13 +337,17 @@ def update_email(student_id: str, new_email: str):
                 text("UPDATE stuid SET email = :new_email, email_history = :new_history WHERE student_id = :student_id"),
                 {"new_email": new_email, "new_history": new_history, "student_id": student_id}
             )
-            return True
+        update_cached_profile(student_id, email=new_email)
+        return True
     except Exception as e:
         print(f"Error updating email: {e}")
         return False
 
 def get_student_email(student_id: str):
     """ایمیل فعلی دانشجو را دریافت می‌کند"""
+    profile = get_cached_profile(student_id)
+    if profile is not None:
+        return profile["email"]
     try:
         with engine.begin() as conn:
             result = conn.execute(
@@ -176,10 +361,13 @@ def get_student_email(student_id: str):
 
 def get_submission_count(student_id: str, hw: str) -> int:
     """تعداد ارسال‌های قبلی دانشجو برای یک تمرین خاص را برمی‌گرداند"""
+    profile = get_cached_profile(student_id)
+    if profile is not None:
+        return profile["submission_counts"].get(hw, 0)
     try:
         with engine.begin() as conn:
             result = conn.execute(
-                text("SELECT COUNT(*) FROM student_results WHERE student_id = :student_id AND hw = :hw"),
+                text("SELECT attempts FROM submission_counters WHERE student_id = :student_id AND hw = :hw"),
                 {"student_id": student_id, "hw": hw}
             ).fetchone()
             return result[0] if result else 0
@@ -188,38 +376,16 @@ def get_submission_count(student_id: str, hw: str) -> int:
         return 0
 
 def save_teacher_query(student_id: str, student_name: str, major: str, query: str, output: str) -> bool:
-    """ذخیره کوئری و خروجی آن در جدول teacher_queries"""
+    """کوئری و خروجی آن را برای ثبت دسته‌ای در جدول teacher_queries در صف می‌گذارد"""
     try:
-        with engine.begin() as conn:
-            # ایجاد جدول اگر وجود ندارد
-            conn.execute(text("""
-                CREATE TABLE IF NOT EXISTS teacher_queries (
-                    id SERIAL PRIMARY KEY,
-                    student_id TEXT NOT NULL,
-                    student_name TEXT NOT NULL,
-                    major TEXT NOT NULL,
-                    query TEXT NOT NULL,
-                    output TEXT,
-                    submission_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """))
-            
-            # درج داده
-            conn.execute(
-                text("""
-                    INSERT INTO teacher_queries 
-                    (student_id, student_name, major, query, output)
-                    VALUES (:student_id, :student_name, :major, :query, :output)
-                """),
-                {
-                    "student_id": student_id,
-                    "student_name": student_name,
-                    "major": major,
-                    "query": query,
-                    "output": output
-                }
-            )
-            return True
+        result_writer.add("teacher_queries", {
+            "student_id": student_id,
+            "student_name": student_name,
+            "major": major,
+            "query": query,
+            "output": output
+        })
+        return True
     except Exception as e:
         print(f"Error saving teacher query: {e}")
         return False
@@ -240,6 +406,10 @@ def get_hw_selection_menu():
     ]
     return ReplyKeyboardMarkup(hw_with_back, one_time_keyboard=True, resize_keyboard=True)
 
+def is_admin(update: Update) -> bool:
+    """بررسی می‌کند که پیام از طرف ادمین ارسال شده است یا خیر"""
+    return str(update.effective_chat.id) == str(ADMIN_CHAT_ID)
+
 def is_query_allowed(query: str) -> bool:
     """بررسی می‌کند که آیا کوئری فقط روی جدول‌های مجاز اجرا می‌شود یا خیر"""
     query = re.sub(r'--.*$', '', query, flags=re.MULTILINE)
@@ -265,15 +435,383 @@ def is_query_allowed(query: str) -> bool:
     all_tables = from_tables + join_tables
     
     # بررسی اینکه همه جدول‌های استفاده شده در لیست مجازها هستند
-    if all_tables and not all(table in allowed_tables for table in all_tables):
+    if not allowed_tables.issuperset(all_tables):
         return False
     
     return True
 
+# ==================== کش پروفایل دانشجو ====================
+
+PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", "1800"))
+
+student_profiles = {}
+_profiles_lock = Lock()
+
+def load_student_profile(student_id: str, password: str):
+    """
+    رمز عبور را بررسی می‌کند و نام، رشته، ایمیل و تعداد ارسال‌های هر تمرین دانشجو را
+    با یک کوئری می‌خواند و در کش قرار می‌دهد. در صورت اشتباه بودن رمز None برمی‌گرداند.
+    """
+    try:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text("""
+                    SELECT s.name, s.major, s.email, c.hw, c.attempts
+                    FROM stuid s
+                    LEFT JOIN submission_counters c ON c.student_id = s.student_id
+                    WHERE s.student_id = :student_id AND s.pass = :password
+                """),
+                {"student_id": student_id, "password": password}
+            ).fetchall()
+    except Exception as e:
+        print(f"Error loading student profile: {e}")
+        return None
+    
+    if not rows:
+        return None
+    profile = {
+        "name": rows[0][0],
+        "major": rows[0][1],
+        "email": rows[0][2] or None,
+        "submission_counts": {hw: count for _, _, _, hw, count in rows if hw is not None},
+        "expires_at": time.monotonic() + PROFILE_CACHE_TTL,
+    }
+    with _profiles_lock:
+        student_profiles[student_id] = profile
+    return profile
+
+def get_cached_profile(student_id: str):
+    """پروفایل دانشجو را در صورت وجود و منقضی نشدن از کش برمی‌گرداند"""
+    profile = student_profiles.get(student_id)
+    if profile is None:
+        return None
+    if profile["expires_at"] < time.monotonic():
+        evict_student_profile(student_id)
+        return None
+    return profile
+
+def update_cached_profile(student_id: str, email: str = None, hw: str = None, submission_count: int = None):
+    """تغییرات ایمیل و تعداد ارسال‌ها را هم‌زمان با ثبت در دیتابیس در کش هم اعمال می‌کند"""
+    with _profiles_lock:
+        profile = student_profiles.get(student_id)
+        if profile is None:
+            return
+        if email is not None:
+            profile["email"] = email
+        if hw is not None and submission_count is not None:
+            profile["submission_counts"][hw] = submission_count
+
+def evict_student_profile(student_id: str):
+    with _profiles_lock:
+        student_profiles.pop(student_id, None)
+
+# ==================== ذخیره وضعیت مکالمه ====================
+
+# memory: فقط در حافظه همین پردازه؛ postgres: جدول conversation_state؛ redis: هر سرور سازگار با Redis
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_REDIS_URL = os.environ.get("STATE_REDIS_URL", "redis://localhost:6379/0")
+# تغییرات هر چت حداکثر با این تأخیر (ثانیه) و در یک نوشتن تجمیع‌شده ذخیره می‌شوند
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "0.2"))
+# نسخه کش‌شده وضعیت یک چت پس از این مدت (ثانیه) دوباره از backend خوانده می‌شود
+STATE_CACHE_TTL = float(os.environ.get("STATE_CACHE_TTL", "2"))
+# وضعیت grading قدیمی‌تر از این مدت (ثانیه) یعنی پردازه‌ای که ارسال را تصحیح می‌کرد از کار افتاده است
+GRADING_STATE_TIMEOUT = int(os.environ.get("GRADING_STATE_TIMEOUT", "900"))
+
+CONVERSATION_STATE_CHANNEL = "conversation_state_changed"
+
+class PostgresStateBackend:
+    def load(self, chat_key: str):
+        with engine.connect() as conn:
+            row = conn.execute(
+                text("SELECT state, user_data, state_changed_at FROM conversation_state WHERE chat_id = :chat_id"),
+                {"chat_id": chat_key}
+            ).fetchone()
+        if not row:
+            return None
+        return {"state": row[0], "user_data": json.loads(row[1]), "state_changed_at": row[2]}
+
+    def save_many(self, records: dict, instance_id: str):
+        with engine.begin() as conn:
+            conn.execute(
+                text("""
+                    INSERT INTO conversation_state (chat_id, state, user_data, state_changed_at, updated_at)
+                    VALUES (:chat_id, :state, :user_data, :state_changed_at, CURRENT_TIMESTAMP)
+                    ON CONFLICT (chat_id) DO UPDATE
+                    SET state = EXCLUDED.state, user_data = EXCLUDED.user_data,
+                        state_changed_at = EXCLUDED.state_changed_at, updated_at = CURRENT_TIMESTAMP
+                """),
+                [
+                    {"chat_id": chat_key, "state": record["state"], "user_data": json.dumps(record["user_data"], ensure_ascii=False), "state_changed_at": record["state_changed_at"]}
+                    for chat_key, record in records.items()
+                ]
+            )
+            # کش نسخه‌های دیگر ربات با این اعلان‌ها (پس از commit) باطل می‌شود
+            conn.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                [{"channel": CONVERSATION_STATE_CHANNEL, "payload": f"{instance_id}:{chat_key}"} for chat_key in records]
+            )
+
+class RedisStateBackend:
+    def __init__(self, url: str):
+        # وابستگی اختیاری؛ فقط برای STATE_BACKEND=redis لازم است
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def load(self, chat_key: str):
+        raw_record = self.client.get(f"conversation_state:{chat_key}")
+        return json.loads(raw_record) if raw_record else None
+
+    def save_many(self, records: dict, instance_id: str):
+        pipeline = self.client.pipeline(transaction=False)
+        for chat_key, record in records.items():
+            pipeline.set(f"conversation_state:{chat_key}", json.dumps(record, ensure_ascii=False))
+        pipeline.execute()
+
+def create_state_backend(name: str):
+    if name == "memory":
+        return None
+    if name == "postgres":
+        return PostgresStateBackend()
+    if name == "redis":
+        return RedisStateBackend(STATE_REDIS_URL)
+    raise ValueError(f"Unknown STATE_BACKEND: {name}")
+
+class ConversationStore:
+    """
+    وضعیت مکالمه و user_data هر چت با کش محلی read-through. تغییرات در کش علامت‌گذاری و هر
+    STATE_FLUSH_INTERVAL ثانیه یک‌جا در backend نوشته می‌شوند، پس چند تغییر پشت سر هم یک چت
+    فقط یک نوشتن دارد. مثل dict قبلی user_state با get و [] استفاده می‌شود.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.instance_id = uuid.uuid4().hex
+        self._records = {}
+        self._loaded_at = {}
+        self._dirty = set()
+        self._saving = set()
+        self._lock = Lock()
+        self._thread = None
+
+    def _is_fresh(self, chat_key: str) -> bool:
+        # تغییری که هنوز نوشته نشده نباید با نسخه قدیمی backend جایگزین شود
+        return (self.backend is None or chat_key in self._dirty or chat_key in self._saving
+                or time.monotonic() - self._loaded_at[chat_key] < STATE_CACHE_TTL)
+
+    def _record(self, chat_id) -> dict:
+        chat_key = str(chat_id)
+        with self._lock:
+            record = self._records.get(chat_key)
+            if record is not None and self._is_fresh(chat_key):
+                return record
+        
+        loaded = None
+        if self.backend is not None:
+            try:
+                loaded = self.backend.load(chat_key)
+            except Exception as e:
+                print(f"Error loading conversation state of {chat_key}: {e}")
+                if record is not None:
+                    return record
+        
+        with self._lock:
+            if chat_key in self._records and self._is_fresh(chat_key):
+                return self._records[chat_key]
+            record = loaded or {"state": None, "user_data": {}, "state_changed_at": 0.0}
+            self._records[chat_key] = record
+            self._loaded_at[chat_key] = time.monotonic()
+            return record
+
+    def _mark_dirty(self, chat_key: str):
+        if self.backend is not None:
+            self._dirty.add(chat_key)
+
+    def get(self, chat_id, default=None):
+        record = self._record(chat_id)
+        if record["state"] == "grading" and time.time() - record["state_changed_at"] > GRADING_STATE_TIMEOUT:
+            return "completed"
+        return default if record["state"] is None else record["state"]
+
+    def __getitem__(self, chat_id):
+        state = self.get(chat_id)
+        if state is None:
+            raise KeyError(chat_id)
+        return state
+
+    def __setitem__(self, chat_id, state: str):
+        record = self._record(chat_id)
+        with self._lock:
+            record["state"] = state
+            record["state_changed_at"] = time.time()
+            self._mark_dirty(str(chat_id))
+
+    def get_user_data(self, chat_id) -> dict:
+        record = self._record(chat_id)
+        with self._lock:
+            return dict(record["user_data"])
+
+    def set_user_data(self, chat_id, user_data: dict):
+        record = self._record(chat_id)
+        with self._lock:
+            if record["user_data"] != user_data:
+                record["user_data"] = dict(user_data)
+                self._mark_dirty(str(chat_id))
+
+    def invalidate(self, chat_key: str = None):
+        """نسخه کش‌شده یک چت (یا همه چت‌ها) را به جز تغییرات هنوز نوشته‌نشده کنار می‌گذارد"""
+        with self._lock:
+            chat_keys = [chat_key] if chat_key is not None else list(self._records)
+            for key in chat_keys:
+                if key not in self._dirty and key not in self._saving:
+                    self._records.pop(key, None)
+                    self._loaded_at.pop(key, None)
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            batch = {chat_key: dict(self._records[chat_key], user_data=dict(self._records[chat_key]["user_data"]))
+                     for chat_key in self._dirty}
+            self._saving.update(batch)
+            self._dirty.clear()
+        try:
+            self.backend.save_many(batch, self.instance_id)
+        except Exception as e:
+            print(f"Error saving conversation state of {len(batch)} chats: {e}")
+            with self._lock:
+                self._saving.difference_update(batch)
+                self._dirty.update(batch)
+            return
+        with self._lock:
+            self._saving.difference_update(batch)
+            now = time.monotonic()
+            for chat_key in batch:
+                self._loaded_at[chat_key] = now
+
+    def start(self):
+        if self.backend is None or self._thread is not None:
+            return
+        self._thread = Thread(target=self._run, name="state-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(STATE_FLUSH_INTERVAL)
+            self.flush()
+
+user_state = ConversationStore(create_state_backend(STATE_BACKEND))
+
+def _on_conversation_state_changed(payload: str):
+    # payload به صورت instance_id:chat_id است؛ payload خالی یعنی ممکن است اعلان‌هایی از دست رفته باشد
+    instance_id, _, chat_key = payload.partition(":")
+    if not payload:
+        user_state.invalidate()
+    elif instance_id != user_state.instance_id:
+        user_state.invalidate(chat_key)
+
+def with_conversation_state(handler):
+    """context.user_data را پیش از اجرای هندلر از user_state بارگذاری و پس از آن ذخیره می‌کند"""
+    if user_state.backend is None:
+        return handler
+    
+    def load_user_data(update: Update, context: CallbackContext):
+        user_data = user_state.get_user_data(update.effective_chat.id)
+        context.user_data.clear()
+        context.user_data.update(user_data)
+    
+    if asyncio.iscoroutinefunction(handler):
+        @wraps(handler)
+        async def async_wrapper(update: Update, context: CallbackContext):
+            await async_runtime.run_blocking(load_user_data, update, context)
+            try:
+                await handler(update, context)
+            finally:
+                await call_user_state(user_state.set_user_data, update.effective_chat.id, context.user_data)
+        return async_wrapper
+    
+    @wraps(handler)
+    def wrapper(update: Update, context: CallbackContext):
+        load_user_data(update, context)
+        try:
+            handler(update, context)
+        finally:
+            user_state.set_user_data(update.effective_chat.id, context.user_data)
+    return wrapper
+
+# ==================== ماشین وضعیت مکالمه ====================
+
+BACK_TO_MENU_TEXT = "🔙 بازگشت به منو اصلی"
+# مرزهای هیستوگرام زمان پردازش پیام (ثانیه)
+STATE_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# وضعیت مکالمه -> هندلر پیام‌های متنی در آن وضعیت
+STATE_HANDLERS = {}
+# متن پیام -> هندلری که در هر وضعیتی بر هندلر وضعیت مقدم است
+SHARED_TRANSITIONS = {}
+
+def state_handler(state: str):
+    """هندلر پیام‌های متنی وضعیت state را در STATE_HANDLERS ثبت می‌کند"""
+    def register(handler):
+        STATE_HANDLERS[state] = handler
+        return handler
+    return register
+
+def shared_transition(message_text: str):
+    """هندلری که با دریافت message_text در هر وضعیتی اجرا می‌شود را ثبت می‌کند"""
+    def register(handler):
+        SHARED_TRANSITIONS[message_text] = handler
+        return handler
+    return register
+
+class LatencyStats:
+    def __init__(self):
+        self.counts = [0] * (len(STATE_LATENCY_BUCKETS) + 1)
+        self.total = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def observe(self, seconds: float):
+        bucket = next((i for i, bound in enumerate(STATE_LATENCY_BUCKETS) if seconds <= bound), len(STATE_LATENCY_BUCKETS))
+        self.counts[bucket] += 1
+        self.total += 1
+        self.total_time += seconds
+        self.max_time = max(self.max_time, seconds)
+
+class StateMetrics:
+    """تعداد و زمان پردازش پیام‌ها به تفکیک وضعیت و انتقال (وضعیت قبل -> وضعیت بعد)"""
+
+    def __init__(self):
+        self.states = {}
+        self.transitions = {}
+        self._lock = Lock()
+
+    def observe(self, state: str, next_state: str, seconds: float):
+        with self._lock:
+            self.states.setdefault(state, LatencyStats()).observe(seconds)
+            self.transitions.setdefault((state, next_state), LatencyStats()).observe(seconds)
+
+    def snapshot(self) -> dict:
+        def summarize(stats: LatencyStats) -> dict:
+            return {
+                "count": stats.total,
+                "avg_ms": stats.total_time / stats.total * 1000 if stats.total else 0.0,
+                "max_ms": stats.max_time * 1000,
+                "histogram": dict(zip([f"<={bound}s" for bound in STATE_LATENCY_BUCKETS] + ["more"], stats.counts)),
+            }
+        with self._lock:
+            return {
+                "states": {state: summarize(stats) for state, stats in self.states.items()},
+                "transitions": {transition: summarize(stats) for transition, stats in self.transitions.items()},
+            }
+
+state_metrics = StateMetrics()
+
 # ==================== توابع اصلی ====================
 
 def start(update: Update, context: CallbackContext):
     chat_id = update.message.chat_id
+    if "student_id" in context.user_data:
+        evict_student_profile(context.user_data["student_id"])
     update.message.reply_text(welcome_text, parse_mode='Markdown')
     user_state[chat_id] = "waiting_student_id"
     update.message.reply_text(
@@ -281,559 +819,2683 @@ def start(update: Update, context: CallbackContext):
         reply_markup=ReplyKeyboardRemove()
     )
 
+def reload_references(update: Update, context: CallbackContext):
+    """دستور ادمین: /reload_references [hw] کش جواب‌های مرجع را پاک می‌کند"""
+    if not is_admin(update):
+        return
+    hw = context.args[0] if context.args else None
+    removed = invalidate_reference_cache(hw)
+    try:
+        with engine.begin() as conn:
+            notify_reference_tables_changed(conn, hw)
+    except Exception as e:
+        print(f"Error notifying reference cache invalidation: {e}")
+    scope = f"تمرین {hw}" if hw else "همه تمرین‌ها"
+    update.message.reply_text(f"♻️ کش جواب‌های مرجع برای {scope} پاک شد ({removed} مورد).")
+
+def refresh_fingerprints(update: Update, context: CallbackContext):
+    """دستور ادمین: /refresh_fingerprints [hw] اثرانگشت جدول‌های مرجع را دوباره محاسبه می‌کند"""
+    if not is_admin(update):
+        return
+    hw = context.args[0] if context.args else None
+    try:
+        refreshed = refresh_reference_fingerprints(hw)
+        update.message.reply_text(f"✅ اثرانگشت {refreshed} جدول مرجع به‌روزرسانی شد.")
+    except Exception as e:
+        print(f"Error refreshing reference fingerprints: {e}")
+        update.message.reply_text(f"❌ خطا در به‌روزرسانی اثرانگشت‌ها: {e}")
+
+def pool_stats(update: Update, context: CallbackContext):
+    """دستور ادمین: /pool_stats وضعیت pool اتصال‌های دیتابیس"""
+    if not is_admin(update):
+        return
+    lines = ["🗄️ وضعیت pool اتصال‌ها\n"]
+    for name, stats in get_pool_stats().items():
+        histogram = ", ".join(f"{bucket}: {count}" for bucket, count in stats["wait_histogram"].items() if count)
+        lines.append(
+            f"• {name}: {stats['checked_out']}/{stats['size']} در حال استفاده، overflow {stats['overflow']}\n"
+            f"  انتظار: {stats['waits']} بار، میانگین {stats['avg_wait_ms']:.1f}ms، بیشینه {stats['max_wait_ms']:.1f}ms، timeout {stats['timeouts']}\n"
+            f"  هیستوگرام: {histogram or '-'}"
+        )
+    update.message.reply_text("\n".join(lines))
+
+def state_stats(update: Update, context: CallbackContext):
+    """دستور ادمین: /state_stats تعداد و زمان پردازش پیام‌ها در هر وضعیت مکالمه"""
+    if not is_admin(update):
+        return
+    snapshot = state_metrics.snapshot()
+    if not snapshot["states"]:
+        update.message.reply_text("📭 هنوز پیامی پردازش نشده است.")
+        return
+    lines = ["🧭 زمان پردازش پیام‌ها به تفکیک وضعیت\n"]
+    for state, stats in sorted(snapshot["states"].items(), key=lambda item: -item[1]["avg_ms"] * item[1]["count"]):
+        histogram = ", ".join(f"{bucket}: {count}" for bucket, count in stats["histogram"].items() if count)
+        lines.append(
+            f"• {state}: {stats['count']} پیام، میانگین {stats['avg_ms']:.1f}ms، بیشینه {stats['max_ms']:.1f}ms\n"
+            f"  هیستوگرام: {histogram}"
+        )
+    lines.append("\n🔀 انتقال‌ها:")
+    for (state, next_state), stats in sorted(snapshot["transitions"].items(), key=lambda item: -item[1]["count"]):
+        lines.append(f"• {state} → {next_state}: {stats['count']} بار، میانگین {stats['avg_ms']:.1f}ms")
+    update.message.reply_text("\n".join(lines)[:TELEGRAM_MESSAGE_LIMIT])
+
 def handle_message(update: Update, context: CallbackContext):
+    """پیام را بر اساس متن (انتقال‌های مشترک) یا وضعیت فعلی چت به هندلر ثبت‌شده در STATE_HANDLERS می‌دهد"""
     chat_id = update.message.chat_id
     text = update.message.text
+    state = user_state.get(chat_id)
     
-    if text == "🔙 بازگشت به منو اصلی":
-        user_state[chat_id] = "completed"
-        update.message.reply_text("🏠 بازگشت به منو اصلی:", reply_markup=get_main_menu())
+    handler = SHARED_TRANSITIONS.get(text) or STATE_HANDLERS.get(state)
+    if handler is None:
         return
     
-    if user_state.get(chat_id) == "waiting_student_id":
-        student_id = text.strip()
-        name, major, _ = get_student_info(student_id)
-        
-        if name and major:
-            context.user_data["student_id"] = student_id
-            context.user_data["name"] = name
-            context.user_data["major"] = major
-            user_state[chat_id] = "waiting_password"
-            update.message.reply_text(
-                "🔐 لطفاً رمز عبور خود را وارد کنید:"
-            )
-        else:
-            update.message.reply_text(
-                "❌ شماره دانشجویی یافت نشد.\n"
-                "🔍 لطفاً شماره دانشجویی صحیح وارد کنید:"
-            )
-    
-    elif user_state.get(chat_id) == "waiting_password":
-        password = text.strip()
-        student_id = context.user_data["student_id"]
-        name, major, _ = get_student_info(student_id, password)
-        
-        if name and major:
-            user_state[chat_id] = "completed"
-            reply_markup = get_main_menu()
-            update.message.reply_text(
-                f"🎉 ورود موفقیت‌آمیز!\n"
-                f"👤 دانشجوی عزیز {name}\n"
-                f"📚 رشته: {major}\n\n"
-                "✨ به ربات پایگاه داده خوش آمدید!\n\n"
-                "🔽 لطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
-                reply_markup=reply_markup
-            )
-        else:
-            update.message.reply_text(
-                "❌ رمز عبور اشتباه است.\n"
-                "🔐 لطفاً رمز عبور صحیح وارد کنید:"
-            )
-    
-    elif user_state.get(chat_id) == "waiting_hw":
-        if text == "🔙 بازگشت به منو اصلی":
-            user_state[chat_id] = "completed"
-            update.message.reply_text("🏠 بازگشت به منو اصلی:", reply_markup=get_main_menu())
-            return
-            
-        hw_number = None
-        if "تمرین 3" in text:
-            hw_number = "3"
-        elif "تمرین 4" in text:
-            hw_number = "4"
-        elif "تمرین 5" in text:
-            hw_number = "5"
-        elif "تمرین 6" in text:
-            hw_number = "6"
-            
-        if hw_number:
-            student_id = context.user_data["student_id"]
-            hw = hw_number
-            
-            submission_count = get_submission_count(student_id, hw)
-            
-            if submission_count >= 10:
-                update.message.reply_text(
-                    f"🚫 شما قبلاً ۱۰ بار تمرین {hw} را ارسال کرده‌اید و حق ارسال مجدد ندارید.\n\n"
-                    "📝 لطفاً تمرین دیگری انتخاب کنید:",
-                    reply_markup=get_hw_selection_menu()
-                )
-                return
-            
-            context.user_data["hw"] = hw
-            user_state[chat_id] = "waiting_sql"
-            remaining_attempts = 10 - submission_count
-            update.message.reply_text(
-                f"✅ تمرین {hw} انتخاب شد!\n\n"
-                f"📊 تعداد ارسال‌های باقی‌مانده: {remaining_attempts}\n\n"
-                "💻 حالا SQL خود را ارسال کنید:\n"
-                "📄 متن مستقیم یا فایل .sql",
-                reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
-            )
-        else:
-            update.message.reply_text("❌ لطفاً شماره تمرین معتبر انتخاب کنید.")
-    
-    elif user_state.get(chat_id) == "waiting_sql":
-        if text == "🔙 بازگشت به منو اصلی":
-            user_state[chat_id] = "completed"
-            update.message.reply_text("🏠 بازگشت به منو اصلی:", reply_markup=get_main_menu())
-            return
-            
-        sql_text = text
-        process_sql(update, context, sql_text)
+    started = time.perf_counter()
+    try:
+        handler(update, context, text)
+    finally:
+        state_metrics.observe(state, user_state.get(chat_id), time.perf_counter() - started)
+
+@shared_transition(BACK_TO_MENU_TEXT)
+def handle_back_to_menu(update: Update, context: CallbackContext, text: str):
+    user_state[update.message.chat_id] = "completed"
+    update.message.reply_text("🏠 بازگشت به منو اصلی:", reply_markup=get_main_menu())
+
+@state_handler("waiting_student_id")
+def handle_waiting_student_id(update: Update, context: CallbackContext, text: str):
+    chat_id = update.message.chat_id
+    student_id = text.strip()
+    name, major, _ = get_student_info(student_id)
     
-    elif user_state.get(chat_id) == "waiting_classroom_sql":
-        if text == "🔙 بازگشت به منو اصلی":
-            user_state[chat_id] = "completed"
-            update.message.reply_text("🏠 بازگشت به منو اصلی:", reply_markup=get_main_menu())
-            return
-            
-        sql_text = text
-        process_classroom_sql(update, context, sql_text)
+    if name and major:
+        context.user_data["student_id"] = student_id
+        context.user_data["name"] = name
+        context.user_data["major"] = major
+        user_state[chat_id] = "waiting_password"
+        update.message.reply_text(
+            "🔐 لطفاً رمز عبور خود را وارد کنید:"
+        )
+    else:
+        update.message.reply_text(
+            "❌ شماره دانشجویی یافت نشد.\n"
+            "🔍 لطفاً شماره دانشجویی صحیح وارد کنید:"
+        )
+
+@state_handler("waiting_password")
+def handle_waiting_password(update: Update, context: CallbackContext, text: str):
+    chat_id = update.message.chat_id
+    password = text.strip()
+    student_id = context.user_data["student_id"]
+    profile = load_student_profile(student_id, password)
     
-    elif user_state.get(chat_id) == "waiting_teacher_submission_decision":
-        if text == "🔙 بازگشت به منو اصلی":
-            user_state[chat_id] = "completed"
-            update.message.reply_text("🏠 بازگشت به منو اصلی:", reply_markup=get_main_menu())
-            return
-        
-        if text == "✅ بله، ارسال به مدرس":
-            # ذخیره کوئری در جدول teacher_queries
-            student_id = context.user_data["student_id"]
-            name = context.user_data["name"]
-            major = context.user_data["major"]
-            query = context.user_data.get("last_query", "")
-            output = context.user_data.get("last_output", "")
-            
-            if save_teacher_query(student_id, name, major, query, output):
-                # ارسال پیام اطلاع‌رسانی به ادمین
-                persian_date, persian_time = get_persian_datetime()
-                admin_message = (
-                    "📤 کوئری جدید برای بررسی\n\n"
-                    f"👤 دانشجو: {name}\n"
-                    f"🆔 شماره دانشجویی: {student_id}\n"
-                    f"📚 رشته: {major}\n"
-                    f"📅 تاریخ: {persian_date}\n"
-                    f"🕐 ساعت: {persian_time}\n\n"
-                    f"💻 کوئری:\n```sql\n{query[:500]}\n```\n\n"
-                    f"📊 تعداد ردیف‌های بازگشتی: {len(json.loads(output)['rows']) if output else 0}"
-                )
-                send_notification_to_admin(context, admin_message)
-                
-                update.message.reply_text(
-                    "✅ کوئری شما با موفقیت برای بررسی به مدرس ارسال شد!\n\n"
-                    "📝 مدرس در اسرع وقت آن را بررسی خواهد کرد.\n\n"
-                    "🏠 بازگشت به منو اصلی:",
-                    reply_markup=get_main_menu()
-                )
-            else:
-                update.message.reply_text(
-                    "❌ خطا در ارسال کوئری به مدرس!\n"
-                    "🔄 لطفاً دوباره تلاش کنید.\n\n"
-                    "🏠 بازگشت به منو اصلی:",
-                    reply_markup=get_main_menu()
-                )
-            
-            user_state[chat_id] = "completed"
+    if profile:
+        name, major = profile["name"], profile["major"]
+        user_state[chat_id] = "completed"
+        reply_markup = get_main_menu()
+        update.message.reply_text(
+            f"🎉 ورود موفقیت‌آمیز!\n"
+            f"👤 دانشجوی عزیز {name}\n"
+            f"📚 رشته: {major}\n\n"
+            "✨ به ربات پایگاه داده خوش آمدید!\n\n"
+            "🔽 لطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
+            reply_markup=reply_markup
+        )
+    else:
+        update.message.reply_text(
+            "❌ رمز عبور اشتباه است.\n"
+            "🔐 لطفاً رمز عبور صحیح وارد کنید:"
+        )
+
+@state_handler("waiting_hw")
+def handle_waiting_hw(update: Update, context: CallbackContext, text: str):
+    chat_id = update.message.chat_id
+    hw_number = None
+    if "تمرین 3" in text:
+        hw_number = "3"
+    elif "تمرین 4" in text:
+        hw_number = "4"
+    elif "تمرین 5" in text:
+        hw_number = "5"
+    elif "تمرین 6" in text:
+        hw_number = "6"
         
-        elif text == "❌ خیر، فقط نمایش":
-            update.message.reply_text(
-                "✅ کوئری فقط برای نمایش اجرا شد و ارسال نشد.\n\n"
-                "💻 می‌توانید کوئری دیگری اجرا کنید:",
-                reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
-            )
-            user_state[chat_id] = "waiting_classroom_sql"
+    if hw_number:
+        student_id = context.user_data["student_id"]
+        hw = hw_number
         
-        else:
-            update.message.reply_text(
-                "❓ لطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
-                reply_markup=ReplyKeyboardMarkup([
-                    ["✅ بله، ارسال به مدرس"],
-                    ["❌ خیر، فقط نمایش"],
-                    ["🔙 بازگشت به منو اصلی"]
-                ], one_time_keyboard=True, resize_keyboard=True)
-            )
-    
-    elif user_state.get(chat_id) == "completed":
-        if text == "🚀 تمرین جدید":
-            user_state[chat_id] = "waiting_hw"
-            reply_markup = get_hw_selection_menu()
-            update.message.reply_text("📝 شماره تمرین جدید را انتخاب کنید:", reply_markup=reply_markup)
-        elif text == "🔐 تغییر رمز عبور":
-            user_state[chat_id] = "waiting_new_password"
-            update.message.reply_text(
-                "🔐 رمز عبور جدید خود را وارد کنید:\n\n"
-                "⚠️ نکات مهم:\n"
-                "• رمز عبور باید حداقل 4 کاراکتر باشد\n",
-                reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
-            )
-        elif text == "📧 ثبت ایمیل اطلاع‌رسانی":
-            student_id = context.user_data["student_id"]
-            current_email = get_student_email(student_id)
-            user_state[chat_id] = "waiting_new_email"
-            
-            email_status = f"📧 ایمیل فعلی: {current_email}" if current_email else "📧 ایمیل فعلی: ثبت نشده"
-            
-            update.message.reply_text(
-                f"📧 ثبت/ویرایش ایمیل اطلاع‌رسانی\n\n"
-                f"{email_status}\n\n"
-                "✉️ ایمیل جدید خود را وارد کنید:\n\n"
-                "⚠️ نکات مهم:\n"
-                "• این ایمیل برای اطلاع‌رسانی‌های مهم استفاده می‌شود\n"
-                "• می‌توانید هر زمان آن را تغییر دهید",
-                reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
-            )
-        elif text == "📊 اجرای کدهای تمرین‌های سرکلاسی":
-            user_state[chat_id] = "waiting_classroom_sql"
-            
-            # دریافت لیست جدول‌های مجاز برای نمایش به کاربر
-            allowed_tables = get_allowed_tables()
-            tables_list = "\n".join([f"• {table}" for table in allowed_tables])
-            
-            update.message.reply_text(
-                f"📊 حالت اجرای کدهای تمرین‌های سرکلاسی\n\n"
-                f"✅ جدول‌های مجاز:\n{tables_list}\n\n"
-                "⚠️ محدودیت‌های این بخش:\n"
-                "• فقط دستورات SELECT مجاز هستند\n"
-                "• فقط می‌توانید از جدول‌های بالا استفاده کنید\n"
-                "• دستورات INSERT, UPDATE, DELETE, DROP, CREATE, ALTER ممنوع هستند\n"
-                "• سایر جدول‌ها غیرقابل دسترسی هستند\n\n"
-                "💻 لطفاً کوئری SELECT خود را ارسال کنید:",
-                reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
-            )
-        elif text == "🔚 پایان":
-            update.message.reply_text(
-                "🙏 متشکرم از استفاده!\n\n"
-                "✨ برای شروع دوباره /start را بزنید.",
-                reply_markup=get_main_menu()
-            )
-        else:
-            update.message.reply_text(
-                "❓ لطفاً یکی از گزینه‌های منو را انتخاب کنید:",
-                reply_markup=get_main_menu()
-            )
-    
-    elif user_state.get(chat_id) == "waiting_new_password":
-        if text == "🔙 بازگشت به منو اصلی":
-            user_state[chat_id] = "completed"
-            update.message.reply_text("🏠 بازگشت به منو اصلی:", reply_markup=get_main_menu())
-            return
+        submission_count = get_submission_count(student_id, hw)
         
-        new_password = text.strip()
-        if len(new_password) < 4:
+        if submission_count >= MAX_SUBMISSIONS:
             update.message.reply_text(
-                "❌ رمز عبور باید حداقل 4 کاراکتر باشد.\n"
-                "🔐 لطفاً رمز عبور جدید را وارد کنید:"
+                f"🚫 شما قبلاً ۱۰ بار تمرین {hw} را ارسال کرده‌اید و حق ارسال مجدد ندارید.\n\n"
+                "📝 لطفاً تمرین دیگری انتخاب کنید:",
+                reply_markup=get_hw_selection_menu()
             )
             return
         
+        context.user_data["hw"] = hw
+        user_state[chat_id] = "waiting_sql"
+        remaining_attempts = MAX_SUBMISSIONS - submission_count
+        update.message.reply_text(
+            f"✅ تمرین {hw} انتخاب شد!\n\n"
+            f"📊 تعداد ارسال‌های باقی‌مانده: {remaining_attempts}\n\n"
+            "💻 حالا SQL خود را ارسال کنید:\n"
+            "📄 متن مستقیم یا فایل .sql",
+            reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+        )
+    else:
+        update.message.reply_text("❌ لطفاً شماره تمرین معتبر انتخاب کنید.")
+
+@state_handler("waiting_sql")
+def handle_waiting_sql(update: Update, context: CallbackContext, text: str):
+    enqueue_submission(update, context, text)
+
+@state_handler("grading")
+def handle_grading(update: Update, context: CallbackContext, text: str):
+    update.message.reply_text(
+        "⏳ ارسال قبلی شما در صف تصحیح است.\n"
+        "📬 به محض پایان تصحیح، نتیجه برای شما ارسال می‌شود."
+    )
+
+@state_handler("waiting_classroom_sql")
+def handle_waiting_classroom_sql(update: Update, context: CallbackContext, text: str):
+    process_classroom_sql(update, context, text)
+
+@state_handler("waiting_teacher_submission_decision")
+def handle_waiting_teacher_submission_decision(update: Update, context: CallbackContext, text: str):
+    chat_id = update.message.chat_id
+    if text == "✅ بله، ارسال به مدرس":
+        # ذخیره کوئری در جدول teacher_queries
         student_id = context.user_data["student_id"]
-        if update_password(student_id, new_password):
-            user_state[chat_id] = "completed"
+        name = context.user_data["name"]
+        major = context.user_data["major"]
+        query = context.user_data.get("last_query", "")
+        output = context.user_data.get("last_output", "")
+        
+        if save_teacher_query(student_id, name, major, query, output):
+            # ارسال پیام اطلاع‌رسانی به ادمین
+            persian_date, persian_time = get_persian_datetime()
+            admin_message = (
+                "📤 کوئری جدید برای بررسی\n\n"
+                f"👤 دانشجو: {name}\n"
+                f"🆔 شماره دانشجویی: {student_id}\n"
+                f"📚 رشته: {major}\n"
+                f"📅 تاریخ: {persian_date}\n"
+                f"🕐 ساعت: {persian_time}\n\n"
+                f"💻 کوئری:\n```sql\n{query[:500]}\n```\n\n"
+                f"📊 تعداد ردیف‌های بازگشتی: {len(json.loads(output)['rows']) if output else 0}"
+            )
+            admin_digest.add(context, "teacher_query", admin_message, student_id, name, detail=query)
+            
             update.message.reply_text(
-                "✅ رمز عبور با موفقیت تغییر یافت!\n\n"
-                "🔐 رمز عبور جدید شما ثبت شد.\n"
-                "💡 لطفاً آن را در جای امنی نگهداری کنید.\n\n"
+                "✅ کوئری شما با موفقیت برای بررسی به مدرس ارسال شد!\n\n"
+                "📝 مدرس در اسرع وقت آن را بررسی خواهد کرد.\n\n"
                 "🏠 بازگشت به منو اصلی:",
                 reply_markup=get_main_menu()
             )
         else:
             update.message.reply_text(
-                "❌ خطا در تغییر رمز عبور!\n"
-                "🔄 لطفاً دوباره تلاش کنید یا با پشتیبانی تماس بگیرید.\n\n"
+                "❌ خطا در ارسال کوئری به مدرس!\n"
+                "🔄 لطفاً دوباره تلاش کنید.\n\n"
                 "🏠 بازگشت به منو اصلی:",
                 reply_markup=get_main_menu()
             )
-            user_state[chat_id] = "completed"
-    
-    elif user_state.get(chat_id) == "waiting_new_email":
-        if text == "🔙 بازگشت به منو اصلی":
-            user_state[chat_id] = "completed"
-            update.message.reply_text("🏠 بازگشت به منو اصلی:", reply_markup=get_main_menu())
-            return
-        
-        new_email = text.strip()
         
-        import re
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not re.match(email_pattern, new_email):
+        user_state[chat_id] = "completed"
+    
+    elif text == "❌ خیر، فقط نمایش":
+        update.message.reply_text(
+            "✅ کوئری فقط برای نمایش اجرا شد و ارسال نشد.\n\n"
+            "💻 می‌توانید کوئری دیگری اجرا کنید:",
+            reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+        )
+        user_state[chat_id] = "waiting_classroom_sql"
+    
+    else:
+        update.message.reply_text(
+            "❓ لطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
+            reply_markup=ReplyKeyboardMarkup([
+                ["✅ بله، ارسال به مدرس"],
+                ["❌ خیر، فقط نمایش"],
+                ["🔙 بازگشت به منو اصلی"]
+            ], one_time_keyboard=True, resize_keyboard=True)
+        )
+
+@state_handler("completed")
+def handle_completed(update: Update, context: CallbackContext, text: str):
+    chat_id = update.message.chat_id
+    if text == "🚀 تمرین جدید":
+        user_state[chat_id] = "waiting_hw"
+        reply_markup = get_hw_selection_menu()
+        update.message.reply_text("📝 شماره تمرین جدید را انتخاب کنید:", reply_markup=reply_markup)
+    elif text == "🔐 تغییر رمز عبور":
+        user_state[chat_id] = "waiting_new_password"
+        update.message.reply_text(
+            "🔐 رمز عبور جدید خود را وارد کنید:\n\n"
+            "⚠️ نکات مهم:\n"
+            "• رمز عبور باید حداقل 4 کاراکتر باشد\n",
+            reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+        )
+    elif text == "📧 ثبت ایمیل اطلاع‌رسانی":
+        student_id = context.user_data["student_id"]
+        current_email = get_student_email(student_id)
+        user_state[chat_id] = "waiting_new_email"
+        
+        email_status = f"📧 ایمیل فعلی: {current_email}" if current_email else "📧 ایمیل فعلی: ثبت نشده"
+        
+        update.message.reply_text(
+            f"📧 ثبت/ویرایش ایمیل اطلاع‌رسانی\n\n"
+            f"{email_status}\n\n"
+            "✉️ ایمیل جدید خود را وارد کنید:\n\n"
+            "⚠️ نکات مهم:\n"
+            "• این ایمیل برای اطلاع‌رسانی‌های مهم استفاده می‌شود\n"
+            "• می‌توانید هر زمان آن را تغییر دهید",
+            reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+        )
+    elif text == "📊 اجرای کدهای تمرین‌های سرکلاسی":
+        user_state[chat_id] = "waiting_classroom_sql"
+        
+        # دریافت لیست جدول‌های مجاز برای نمایش به کاربر
+        allowed_tables = get_allowed_tables()
+        tables_list = "\n".join([f"• {table}" for table in sorted(allowed_tables)])
+        
+        update.message.reply_text(
+            f"📊 حالت اجرای کدهای تمرین‌های سرکلاسی\n\n"
+            f"✅ جدول‌های مجاز:\n{tables_list}\n\n"
+            "⚠️ محدودیت‌های این بخش:\n"
+            "• فقط دستورات SELECT مجاز هستند\n"
+            "• فقط می‌توانید از جدول‌های بالا استفاده کنید\n"
+            "• دستورات INSERT, UPDATE, DELETE, DROP, CREATE, ALTER ممنوع هستند\n"
+            "• سایر جدول‌ها غیرقابل دسترسی هستند\n\n"
+            "💻 لطفاً کوئری SELECT خود را ارسال کنید:",
+            reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+        )
+    elif text == "🔚 پایان":
+        # دانشجویی که بدون ورود به منو برگشته student_id ندارد
+        student_id = context.user_data.get("student_id")
+        if student_id is not None:
+            evict_student_profile(student_id)
+        update.message.reply_text(
+            "🙏 متشکرم از استفاده!\n\n"
+            "✨ برای شروع دوباره /start را بزنید.",
+            reply_markup=get_main_menu()
+        )
+    else:
+        update.message.reply_text(
+            "❓ لطفاً یکی از گزینه‌های منو را انتخاب کنید:",
+            reply_markup=get_main_menu()
+        )
+
+@state_handler("waiting_new_password")
+def handle_waiting_new_password(update: Update, context: CallbackContext, text: str):
+    chat_id = update.message.chat_id
+    new_password = text.strip()
+    if len(new_password) < 4:
+        update.message.reply_text(
+            "❌ رمز عبور باید حداقل 4 کاراکتر باشد.\n"
+            "🔐 لطفاً رمز عبور جدید را وارد کنید:"
+        )
+        return
+    
+    student_id = context.user_data["student_id"]
+    if update_password(student_id, new_password):
+        user_state[chat_id] = "completed"
+        update.message.reply_text(
+            "✅ رمز عبور با موفقیت تغییر یافت!\n\n"
+            "🔐 رمز عبور جدید شما ثبت شد.\n"
+            "💡 لطفاً آن را در جای امنی نگهداری کنید.\n\n"
+            "🏠 بازگشت به منو اصلی:",
+            reply_markup=get_main_menu()
+        )
+    else:
+        update.message.reply_text(
+            "❌ خطا در تغییر رمز عبور!\n"
+            "🔄 لطفاً دوباره تلاش کنید یا با پشتیبانی تماس بگیرید.\n\n"
+            "🏠 بازگشت به منو اصلی:",
+            reply_markup=get_main_menu()
+        )
+        user_state[chat_id] = "completed"
+
+@state_handler("waiting_new_email")
+def handle_waiting_new_email(update: Update, context: CallbackContext, text: str):
+    chat_id = update.message.chat_id
+    new_email = text.strip()
+    
+    email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+    if not re.match(email_pattern, new_email):
+        update.message.reply_text(
+            "❌ فرمت ایمیل صحیح نیست.\n\n"
+            "💡 مثال صحیح: name@gmail.com\n"
+            "📧 لطفاً ایمیل معتبر وارد کنید:"
+        )
+        return
+    
+    student_id = context.user_data["student_id"]
+    if update_email(student_id, new_email):
+        user_state[chat_id] = "completed"
+        
+        # ارسال پیام اطلاع‌رسانی به ادمین
+        persian_date, persian_time = get_persian_datetime()
+        admin_message = (
+            "🔔 اطلاع‌رسانی ثبت/ویرایش ایمیل\n\n"
+            f"👤 دانشجو: {context.user_data['name']}\n"
+            f"🆔 شماره دانشجویی: {student_id}\n"
+            f"📚 رشته: {context.user_data['major']}\n"
+            f"📧 ایمیل جدید: {new_email}\n"
+            f"📅 تاریخ: {persian_date}\n"
+            f"🕐 ساعت: {persian_time}"
+        )
+        admin_digest.add(context, "email_change", admin_message, student_id, context.user_data["name"], detail=new_email)
+        
+        update.message.reply_text(
+            "✅ ایمیل با موفقیت ثبت/به‌روزرسانی شد!\n\n"
+            f"📧 ایمیل شما: {new_email}\n\n"
+            "📢 از این پس اطلاع‌رسانی‌های مهم به این ایمیل ارسال می‌شود.\n"
+            "🔄 می‌توانید هر زمان آن را تغییر دهید.\n\n"
+            "🏠 بازگشت به منو اصلی:",
+            reply_markup=get_main_menu()
+        )
+    else:
+        update.message.reply_text(
+            "❌ خطا در ثبت ایمیل!\n"
+            "🔄 لطفاً دوباره تلاش کنید یا با پشتیبانی تماس بگیرید.\n\n"
+            "🏠 بازگشت به منو اصلی:",
+            reply_markup=get_main_menu()
+        )
+        user_state[chat_id] = "completed"
+
+def handle_document(update: Update, context: CallbackContext):
+    chat_id = update.message.chat_id
+    
+    if user_state.get(chat_id) == "waiting_sql":
+        document: Document = update.message.document
+        if not document.file_name.endswith(".sql"):
             update.message.reply_text(
-                "❌ فرمت ایمیل صحیح نیست.\n\n"
-                "💡 مثال صحیح: name@gmail.com\n"
-                "📧 لطفاً ایمیل معتبر وارد کنید:"
+                "❌ لطفاً یک فایل معتبر .sql ارسال کنید.\n\n"
+                "یا برای بازگشت به منو اصلی دکمه زیر را بزنید:",
+                reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
             )
             return
         
-        student_id = context.user_data["student_id"]
-        if update_email(student_id, new_email):
-            user_state[chat_id] = "completed"
+        try:
+            sql_text, questions = read_sql_document(document)
+        except SubmissionTooLarge:
+            reply_document_too_large(update)
+            return
+        except Exception as e:
+            reply_document_download_failed(update, e)
+            return
+        enqueue_submission(update, context, sql_text, questions)
+    
+    elif user_state.get(chat_id) == "grading":
+        update.message.reply_text(
+            "⏳ ارسال قبلی شما در صف تصحیح است.\n"
+            "📬 به محض پایان تصحیح، نتیجه برای شما ارسال می‌شود."
+        )
+    
+    elif user_state.get(chat_id) == "waiting_classroom_sql":
+        update.message.reply_text(
+            "❌ در حالت اجرای کدهای تمرین‌های سرکلاسی، فقط ارسال متن مستقیم مجاز است.\n"
+            "💻 لطفاً کوئری خود را به صورت متن ارسال کنید:",
+            reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+        )
+    else:
+        update.message.reply_text("لطفاً مراحل را از /start دنبال کنید.")
+
+# ==================== محدودیت منابع کوئری دانشجو ====================
+
+# حالت‌های اجرای کوئری دانشجو: grading (تصحیح تمرین) و classroom (تمرین‌های سرکلاسی)
+STATEMENT_TIMEOUT_MS = {
+    "grading": int(os.environ.get("GRADING_STATEMENT_TIMEOUT_MS", "10000")),
+    "classroom": int(os.environ.get("CLASSROOM_STATEMENT_TIMEOUT_MS", "5000")),
+}
+# سقف تعداد ردیف نتیجه (۰ یعنی بدون محدودیت)
+MAX_RESULT_ROWS = {
+    "grading": int(os.environ.get("GRADING_MAX_ROWS", "100000")),
+    "classroom": int(os.environ.get("CLASSROOM_MAX_ROWS", "10000")),
+}
+STUDENT_WORK_MEM = os.environ.get("STUDENT_WORK_MEM")  # مثلاً 16MB
+STUDENT_TEMP_FILE_LIMIT = os.environ.get("STUDENT_TEMP_FILE_LIMIT")  # مثلاً 100MB (نیازمند دسترسی superuser)
+
+OUTCOME_CORRECT = "correct"
+OUTCOME_INCORRECT = "incorrect"
+OUTCOME_ERROR = "error"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_TOO_LARGE = "too_large"
+
+class QueryTooLarge(Exception):
+    """تعداد ردیف‌های نتیجه کوئری از سقف مجاز بیشتر است"""
+
+def is_statement_timeout(error: Exception) -> bool:
+    """بررسی می‌کند که خطا ناشی از لغو کوئری به خاطر statement_timeout باشد (SQLSTATE 57014)"""
+    orig = getattr(error, "orig", error)
+    return (getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)) == "57014"
+
+def apply_resource_limits(conn, mode: str):
+    """محدودیت‌های زمان و حافظه را فقط برای تراکنش جاری (SET LOCAL) اعمال می‌کند"""
+    if conn.dialect.name != "postgresql":
+        return
+    settings = {"statement_timeout": str(STATEMENT_TIMEOUT_MS[mode])}
+    if STUDENT_WORK_MEM:
+        settings["work_mem"] = STUDENT_WORK_MEM
+    for name, value in settings.items():
+        conn.execute(text("SELECT set_config(:name, :value, true)"), {"name": name, "value": value})
+    if STUDENT_TEMP_FILE_LIMIT:
+        try:
+            with conn.begin_nested():
+                conn.execute(text("SELECT set_config('temp_file_limit', :value, true)"), {"value": STUDENT_TEMP_FILE_LIMIT})
+        except Exception as e:
+            print(f"Could not apply temp_file_limit: {e}")
+
+# ==================== مقایسه نتایج ====================
+
+FINGERPRINT_BATCH_SIZE = int(os.environ.get("FINGERPRINT_BATCH_SIZE", "1000"))
+_FINGERPRINT_MODULUS = 1 << 128
+
+def _canonical_value(value):
+    """مقدار یک ستون را به شکلی مستقل از نوع عددی (int/float/Decimal) برمی‌گرداند"""
+    if value is None:
+        return ("null",)
+    if isinstance(value, (int, float, Decimal)):
+        number = Decimal(value)
+        if number.is_finite() and number == 0:
+            return ("n", "0")
+        return ("n", str(number.normalize()))
+    if isinstance(value, str):
+        return ("s", value)
+    if isinstance(value, (list, tuple)):
+        return ("a", tuple(_canonical_value(item) for item in value))
+    if isinstance(value, memoryview):
+        return ("b", bytes(value))
+    return (type(value).__name__, repr(value))
+
+def _row_digest(row) -> int:
+    """هش ۱۲۸ بیتی یک ردیف"""
+    canonical = repr(tuple(_canonical_value(value) for value in row)).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(canonical, digest_size=16).digest(), "big")
+
+def _partition_digest(batch) -> int:
+    """مجموع هش ردیف‌های یک دسته"""
+    return sum(_row_digest(row) for row in batch) % _FINGERPRINT_MODULUS
+
+def stream_fingerprint(conn, query: str, max_rows: int = 0):
+    """
+    نتیجه کوئری را با cursor سمت سرور و به صورت دسته‌ای می‌خواند و اثرانگشت
+    چندمجموعه‌ای آن یعنی (تعداد ردیف، مجموع هش ردیف‌ها) را برمی‌گرداند.
+    این اثرانگشت به ترتیب ردیف‌ها وابسته نیست ولی ردیف‌های تکراری را می‌شمارد.
+    اگر max_rows تعیین شده باشد و نتیجه از آن بیشتر شود QueryTooLarge رخ می‌دهد.
+    """
+    result = conn.execute(text(query), execution_options={"yield_per": FINGERPRINT_BATCH_SIZE})
+    row_count = 0
+    digest = 0
+    for batch in result.partitions():
+        row_count += len(batch)
+        if max_rows and row_count > max_rows:
+            result.close()
+            raise QueryTooLarge(f"query returned more than {max_rows} rows")
+        digest = (digest + _partition_digest(batch)) % _FINGERPRINT_MODULUS
+    return row_count, digest
+
+# ==================== کش جواب‌های مرجع ====================
+
+REFERENCE_CACHE_SIZE = int(os.environ.get("REFERENCE_CACHE_SIZE", "256"))
+
+class LRUCache:
+    """کش LRU با اندازه محدود و thread-safe؛ هر invalidate نسخه کش را یکی بالا می‌برد"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, version: int = None):
+        """مقدار را ذخیره می‌کند؛ اگر از زمان خواندن نسخه، کش invalidate شده باشد مقدار کهنه ذخیره نمی‌شود"""
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, predicate=None) -> int:
+        """کلیدهایی که predicate برایشان True است (یا همه کلیدها) را حذف می‌کند"""
+        with self._lock:
+            self.version += 1
+            if predicate is None:
+                removed = len(self._items)
+                self._items.clear()
+                return removed
+            keys = [key for key in self._items if predicate(key)]
+            for key in keys:
+                del self._items[key]
+            return len(keys)
+
+    def __len__(self):
+        return len(self._items)
+
+reference_cache = LRUCache(REFERENCE_CACHE_SIZE)
+
+def get_reference_fingerprint(conn, hw: str, question_number: int, major: str):
+    """اثرانگشت جواب مرجع را از کش یا در صورت نبود، از دیتابیس برمی‌گرداند"""
+    fingerprint = reference_cache.get((hw, question_number, major))
+    if fingerprint is None:
+        fingerprint = load_reference_fingerprint(conn, hw, question_number, major)
+    return fingerprint
+
+def load_reference_fingerprint(conn, hw: str, question_number: int, major: str):
+    """اثرانگشت جواب مرجع را از دیتابیس می‌خواند و در کش ذخیره می‌کند"""
+    version = reference_cache.version
+    if GRADING_MODE == "server":
+        fingerprint = load_server_reference_fingerprint(conn, hw, question_number, major)
+    else:
+        reference_table = get_reference_table(hw, question_number, major)
+        fingerprint = stream_fingerprint(conn, f"SELECT * FROM {reference_table}")
+    reference_cache.put((hw, question_number, major), fingerprint, version)
+    return fingerprint
+
+def invalidate_reference_cache(hw: str = None) -> int:
+    """کش جواب‌های مرجع را برای یک تمرین یا همه تمرین‌ها پاک می‌کند"""
+    if hw is None:
+        return reference_cache.invalidate()
+    return reference_cache.invalidate(lambda key: key[0] == hw)
+
+def notify_reference_tables_changed(conn, hw: str = None):
+    """
+    به همه پردازه‌های ربات (و نسخه‌های دیگر) اعلام می‌کند که کش جواب‌های مرجع را پاک کنند؛
+    اعلان پس از commit تراکنش conn تحویل داده می‌شود.
+    """
+    if conn.dialect.name == "postgresql":
+        conn.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": REFERENCE_TABLES_CHANNEL, "payload": hw or ""}
+        )
+
+# ==================== اثرانگشت سمت سرور ====================
+
+# stream: ردیف‌ها در پایتون هش می‌شوند / server: هش در خود Postgres محاسبه می‌شود
+GRADING_MODE = os.environ.get("GRADING_MODE", "stream")
+
+_REFERENCE_TABLE_PATTERN = re.compile(r"^hw(\d+)_q(\d+)_(stat|cs)_reference$")
+
+# مجموع هش ۶۴ بیتی ردیف‌ها؛ مستقل از ترتیب و حساس به ردیف‌های تکراری.
+# ROW(t.*) حتی اگر نتیجه ستونی به نام t داشته باشد کل ردیف را هش می‌کند (t::text در آن حالت فقط همان ستون است).
+# برخلاف _canonical_value در حالت stream، شکل متنی مقدارها هش می‌شود؛ پس 85.5 و 85.50 یا 1 و 1.0
+# در این حالت متفاوت‌اند و نوع و scale ستون‌های عددی جواب دانشجو باید با جدول مرجع یکی باشد.
+_SERVER_DIGEST_EXPR = "COALESCE(SUM(('x' || SUBSTR(MD5(ROW(t.*)::text), 1, 16))::bit(64)::bigint::numeric), 0)"
+
+def get_major_track(major: str) -> str:
+    """پسوند جدول‌های مرجع برای هر رشته"""
+    return "stat" if major == "آمار" else "cs"
+
+def get_reference_table(hw: str, question_number: int, major: str) -> str:
+    """نام جدول جواب مرجع یک سوال را برمی‌گرداند"""
+    return f"hw{hw}_q{question_number}_{get_major_track(major)}_reference"
+
+def _strip_terminator(query: str) -> str:
+    """کامنت‌های انتهایی و ; پایانی را حذف می‌کند تا کوئری داخل subquery قابل استفاده باشد"""
+    lines = query.strip().splitlines()
+    while lines and (not lines[-1].strip() or lines[-1].strip().startswith("--")):
+        lines.pop()
+    return "\n".join(lines).strip().rstrip(";").strip()
+
+def _server_fingerprint_sql(query: str):
+    return text(f"SELECT COUNT(*), {_SERVER_DIGEST_EXPR} FROM (\n{_strip_terminator(query)}\n) AS t")
+
+def server_fingerprint(conn, query: str):
+    """اثرانگشت نتیجه کوئری را داخل Postgres محاسبه می‌کند و فقط دو عدد منتقل می‌شود"""
+    row = conn.execute(_server_fingerprint_sql(query)).fetchone()
+    return int(row[0]), int(row[1])
+
+def store_reference_fingerprint(conn, hw: str, question_number: int, track: str):
+    """اثرانگشت جدول مرجع را داخل Postgres محاسبه و در reference_fingerprints ذخیره می‌کند"""
+    reference_table = f"hw{hw}_q{question_number}_{track}_reference"
+    row = conn.execute(
+        text(f"""
+            INSERT INTO reference_fingerprints (hw, question, track, row_count, digest)
+            SELECT :hw, :question, :track, COUNT(*), {_SERVER_DIGEST_EXPR} FROM {reference_table} AS t
+            ON CONFLICT (hw, question, track) DO UPDATE
+            SET row_count = EXCLUDED.row_count, digest = EXCLUDED.digest, updated_at = CURRENT_TIMESTAMP
+            RETURNING row_count, digest
+        """),
+        {"hw": hw, "question": question_number, "track": track}
+    ).fetchone()
+    return int(row[0]), int(row[1])
+
+def load_server_reference_fingerprint(conn, hw: str, question_number: int, major: str):
+    """اثرانگشت ذخیره‌شده مرجع را می‌خواند و اگر هنوز محاسبه نشده باشد آن را می‌سازد"""
+    track = get_major_track(major)
+    row = conn.execute(
+        text("SELECT row_count, digest FROM reference_fingerprints WHERE hw = :hw AND question = :question AND track = :track"),
+        {"hw": hw, "question": question_number, "track": track}
+    ).fetchone()
+    if row:
+        return int(row[0]), int(row[1])
+    # conn ممکن است به replica فقط‌خواندنی وصل باشد؛ ذخیره اثرانگشت همیشه روی دیتابیس اصلی انجام می‌شود
+    with engine.begin() as primary_conn:
+        return store_reference_fingerprint(primary_conn, hw, question_number, track)
+
+def refresh_reference_fingerprints(hw: str = None) -> int:
+    """اثرانگشت همه جدول‌های مرجع (یا جدول‌های یک تمرین) را دوباره محاسبه می‌کند"""
+    refreshed = 0
+    with engine.begin() as conn:
+        tables = conn.execute(text(
+            "SELECT table_name FROM information_schema.tables "
+            "WHERE table_schema = current_schema() AND table_name LIKE 'hw%\\_reference'"
+        )).fetchall()
+        for (table_name,) in tables:
+            match = _REFERENCE_TABLE_PATTERN.match(table_name)
+            if not match or (hw is not None and match.group(1) != hw):
+                continue
+            store_reference_fingerprint(conn, match.group(1), int(match.group(2)), match.group(3))
+            refreshed += 1
+        notify_reference_tables_changed(conn, hw)
+    invalidate_reference_cache(hw)
+    return refreshed
+
+def grade_question(conn, hw: str, question_number: int, major: str, student_query: str) -> str:
+    """یک سوال را تصحیح می‌کند؛ هر سوال در savepoint جدا اجرا می‌شود تا خطای آن بقیه را خراب نکند"""
+    max_rows = MAX_RESULT_ROWS["grading"]
+    with conn.begin_nested():
+        if GRADING_MODE == "server":
+            student_fingerprint = server_fingerprint(conn, student_query)
+            if max_rows and student_fingerprint[0] > max_rows:
+                raise QueryTooLarge(f"query returned more than {max_rows} rows")
+        else:
+            student_fingerprint = stream_fingerprint(conn, student_query, max_rows)
+        reference_fingerprint = get_reference_fingerprint(conn, hw, question_number, major)
+    return OUTCOME_CORRECT if student_fingerprint == reference_fingerprint else OUTCOME_INCORRECT
+
+# ==================== کش نتیجه ارسال‌های تکراری ====================
+
+SUBMISSION_MEMO_SIZE = int(os.environ.get("SUBMISSION_MEMO_SIZE", "10000"))
+
+_SQL_TOKEN_PATTERN = re.compile(r"""
+    (?P<escape_string>[Ee]'(?:[^'\\]|\\.|'')*')
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<dollar_string>\$(?P<dollar_tag>(?:[A-Za-z_][A-Za-z0-9_]*)?)\$.*?\$(?P=dollar_tag)\$)
+  | (?P<identifier>"(?:[^"]|"")*")
+  | (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<space>\s+)
+  | (?P<other>[\w$]+|.)
+""", re.VERBOSE | re.DOTALL)
+
+submission_memo = LRUCache(SUBMISSION_MEMO_SIZE)
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char in "_$'\""
+
+def normalize_sql(query: str) -> str:
+    """
+    کوئری را برای مقایسه ارسال‌های تکراری یکسان‌سازی می‌کند: حذف کامنت‌ها،
+    فشرده‌سازی فاصله‌ها و حروف کوچک بیرون از رشته‌ها و شناسه‌های نقل‌قول‌شده.
+    """
+    parts = []
+    pending_space = False
+    for match in _SQL_TOKEN_PATTERN.finditer(query):
+        kind = match.lastgroup
+        token = match.group()
+        if kind in ("comment", "space"):
+            pending_space = True
+            continue
+        if kind == "other":
+            token = token.lower()
+        if pending_space and parts and _is_word_char(parts[-1][-1]) and _is_word_char(token[0]):
+            parts.append(" ")
+        parts.append(token)
+        pending_space = False
+    return "".join(parts).rstrip(";").strip()
+
+def get_memo_key(student_query: str, hw: str, question_number: int, major: str, reference_version: int):
+    """کلید کش نتیجه یک سوال؛ با تغییر نسخه جواب‌های مرجع، نتایج قبلی دیگر استفاده نمی‌شوند"""
+    query_hash = hashlib.sha256(normalize_sql(student_query).encode("utf-8")).hexdigest()
+    return (query_hash, hw, question_number, major, reference_version)
+
+# ==================== تصحیح موازی ====================
+
+# حداکثر تعداد سوال‌هایی از یک ارسال که هم‌زمان تصحیح می‌شوند (۱ یعنی ترتیبی)
+GRADING_PARALLELISM = int(os.environ.get("GRADING_PARALLELISM", "1"))
+GRADING_POOL_WORKERS = int(os.environ.get("GRADING_POOL_WORKERS", "8"))
+# سقف زمان کل تصحیح یک ارسال به ثانیه (۰ یعنی بدون محدودیت)
+GRADING_TIME_BUDGET = float(os.environ.get("GRADING_TIME_BUDGET", "0"))
+
+grading_executor = ThreadPoolExecutor(max_workers=GRADING_POOL_WORKERS, thread_name_prefix="grading")
+
+def _grading_error_outcome(question_number: int, error: Exception) -> str:
+    if isinstance(error, QueryTooLarge):
+        print(f"Query {question_number} too large: {error}")
+        return OUTCOME_TOO_LARGE
+    print(f"Error executing query {question_number}: {error}")
+    return OUTCOME_TIMEOUT if is_statement_timeout(error) else OUTCOME_ERROR
+
+def _grade_question_safely(conn, hw: str, question_number: int, major: str, student_query: str) -> str:
+    try:
+        return grade_question(conn, hw, question_number, major, student_query)
+    except Exception as e:
+        return _grading_error_outcome(question_number, e)
+
+def _grade_question_on_own_connection(hw: str, question_number: int, major: str, student_query: str, deadline=None) -> str:
+    """هر سوال روی یک اتصال جداگانه از pool تصحیح می‌شود"""
+    with grading_engine.begin() as conn:
+        apply_resource_limits(conn, "grading")
+        apply_question_deadline(conn, deadline)
+        return _grade_question_safely(conn, hw, question_number, major, student_query)
+
+def _remaining_time(deadline):
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+def apply_question_deadline(conn, deadline):
+    """
+    statement_timeout سوال بعدی را به زمان باقی‌مانده از بودجه ارسال محدود می‌کند تا بودجه روی
+    خود سرور اعمال شود و کوئری کندی که بودجه را تمام کرده اتصالش را نگه ندارد.
+    """
+    if deadline is None or conn.dialect.name != "postgresql":
+        return
+    timeout_ms = max(1, int(_remaining_time(deadline) * 1000))
+    if STATEMENT_TIMEOUT_MS["grading"]:
+        timeout_ms = min(timeout_ms, STATEMENT_TIMEOUT_MS["grading"])
+    conn.execute(text("SELECT set_config('statement_timeout', :value, true)"), {"value": str(timeout_ms)})
+
+def _pending_questions(questions, hw: str, major: str, results: dict, memo_keys: dict):
+    """
+    سوال‌ها را به ترتیب رسیدن از splitter می‌خواند و فقط سوال‌هایی را که نتیجه‌شان
+    در کش ارسال‌های قبلی نیست برای اجرا برمی‌گرداند.
+    """
+    reference_version = reference_cache.version
+    for question_number, student_query in questions:
+        # سوال‌هایی که تا پایان بودجه زمانی تصحیح نشوند timeout حساب می‌شوند
+        results[question_number] = OUTCOME_TIMEOUT
+        memo_keys[question_number] = get_memo_key(student_query, hw, question_number, major, reference_version)
+        cached_outcome = submission_memo.get(memo_keys[question_number])
+        if cached_outcome is not None:
+            results[question_number] = cached_outcome
+        else:
+            yield question_number, student_query
+
+def _grade_sequentially(conn, hw: str, major: str, pending, deadline, results: dict, graded: list):
+    """سوال‌های در انتظار را یکی پس از دیگری روی یک اتصال تصحیح می‌کند"""
+    for question_number, student_query in pending:
+        if deadline is not None and time.monotonic() >= deadline:
+            print(f"Grading budget exceeded before question {question_number}")
+            continue
+        apply_question_deadline(conn, deadline)
+        results[question_number] = _grade_question_safely(conn, hw, question_number, major, student_query)
+        graded.append(question_number)
+
+def _remember_outcomes(results: dict, memo_keys: dict, graded: list):
+    # فقط نتیجه‌های قطعی کش می‌شوند؛ خطا و timeout ممکن است در ارسال بعدی تکرار نشوند
+    for question_number in graded:
+        if results[question_number] in (OUTCOME_CORRECT, OUTCOME_INCORRECT):
+            submission_memo.put(memo_keys[question_number], results[question_number])
+
+def grade_submission(hw: str, major: str, questions) -> dict:
+    """
+    سوال‌های یک ارسال را که به صورت (شماره سوال، کوئری) می‌رسند تصحیح می‌کند و
+    نتیجه هر سوال را به صورت {شماره سوال: outcome} برمی‌گرداند.
+    """
+    deadline = time.monotonic() + GRADING_TIME_BUDGET if GRADING_TIME_BUDGET > 0 else None
+    results = {}
+    memo_keys = {}
+    pending = _pending_questions(questions, hw, major, results, memo_keys)
+    graded = []
+    
+    if GRADING_PARALLELISM <= 1:
+        with grading_engine.begin() as conn:
+            apply_resource_limits(conn, "grading")
+            _grade_sequentially(conn, hw, major, pending, deadline, results, graded)
+    else:
+        fan_out = BoundedSemaphore(GRADING_PARALLELISM)
+        futures = {}
+        for question_number, student_query in pending:
+            if not fan_out.acquire(timeout=_remaining_time(deadline)):
+                print(f"Grading budget exceeded before question {question_number}")
+                continue
+            future = grading_executor.submit(_grade_question_on_own_connection, hw, question_number, major, student_query, deadline)
+            future.add_done_callback(lambda _: fan_out.release())
+            futures[future] = question_number
+        
+        done, not_done = wait(futures, timeout=_remaining_time(deadline))
+        for future in not_done:
+            future.cancel()
+            print(f"Grading budget exceeded for question {futures[future]}")
+        for future in done:
+            results[futures[future]] = future.result()
+            graded.append(futures[future])
+    
+    _remember_outcomes(results, memo_keys, graded)
+    return results
+
+# ==================== تقسیم ارسال به سوال‌ها ====================
+
+# dash: نشانه "-- #N" قبل از هر سوال / number: نشانه "# number N"
+SUBMISSION_MARKER_STYLE = os.environ.get("SUBMISSION_MARKER_STYLE", "dash")
+
+_MARKER_PATTERNS = {
+    "dash": re.compile(r"--\s*#\s*(\d+)"),
+    "number": re.compile(r"#\s*number\s*(\d+)", re.IGNORECASE),
+}
+_DOLLAR_TAG_PATTERN = re.compile(r"\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$")
+
+def _has_escape_prefix(line: str, quote_index: int) -> bool:
+    """آیا ' در این موقعیت شروع رشته E'...' (با escape بک‌اسلش) است"""
+    if quote_index < 1 or line[quote_index - 1] not in "Ee":
+        return False
+    return quote_index < 2 or not (line[quote_index - 2].isalnum() or line[quote_index - 2] in "_$")
+
+def _escape_string_end(line: str, i: int) -> int:
+    """موقعیت بعد از ' پایانی رشته E'...' یا -1 اگر رشته در این خط تمام نشود"""
+    while i < len(line):
+        if line[i] == "\\":
+            i += 2
+        elif line.startswith("''", i):
+            i += 2
+        elif line[i] == "'":
+            return i + 1
+        else:
+            i += 1
+    return -1
+
+class SubmissionSplitter:
+    """
+    متن ارسال را به صورت جریانی توکن‌بندی می‌کند و به ازای هر سوال (شماره سوال، کوئری) برمی‌گرداند.
+    نشانه سوال داخل رشته‌ها (از جمله E'...')، شناسه‌های نقل‌قول‌شده، dollar-quoting و کامنت‌های چندخطی نادیده گرفته
+    می‌شود و کامنت‌ها و فاصله‌های بعد از آخرین دستور (مثلاً بعد از ;) از کوئری حذف می‌شوند.
+    متن به صورت خط به خط پردازش می‌شود؛ هیچ توکنی به جز رشته‌ها و کامنت‌های چندخطی از مرز خط عبور
+    نمی‌کند و وضعیت آن‌ها بین خط‌ها نگه داشته می‌شود.
+    """
+
+    def __init__(self, marker_style: str = None):
+        marker_style = marker_style or SUBMISSION_MARKER_STYLE
+        self._marker = _MARKER_PATTERNS[marker_style]
+        self._hash_markers = marker_style == "number"
+        self._state = "code"
+        self._closing = None
+        self._block_depth = 0
+        self._partial_line = ""
+        self._question_number = None
+        self._parts = []
+        self._length = 0
+        self._code_end = 0
+        self._ready = []
+
+    def feed(self, chunk: str) -> list:
+        """یک تکه از متن را پردازش می‌کند و سوال‌هایی که کامل شده‌اند را برمی‌گرداند"""
+        lines = (self._partial_line + chunk).split("\n")
+        self._partial_line = lines.pop()
+        for line in lines:
+            self._process_line(line + "\n")
+        return self._take_ready()
+
+    def close(self) -> list:
+        """پایان متن؛ آخرین سوال را برمی‌گرداند"""
+        if self._partial_line:
+            self._process_line(self._partial_line)
+            self._partial_line = ""
+        self._finish_question()
+        return self._take_ready()
+
+    def _take_ready(self) -> list:
+        ready, self._ready = self._ready, []
+        return ready
+
+    def _append(self, text: str, is_code: bool):
+        self._parts.append(text)
+        self._length += len(text)
+        if is_code:
+            self._code_end = self._length
+
+    def _append_code(self, text: str):
+        stripped = text.rstrip()
+        self._append(stripped, bool(stripped))
+        if len(stripped) < len(text):
+            self._append(text[len(stripped):], False)
+
+    def _finish_question(self):
+        if self._code_end:
+            statement = "".join(self._parts)[:self._code_end].strip()
+            self._ready.append((self._question_number or 1, statement))
+        self._parts = []
+        self._length = 0
+        self._code_end = 0
+
+    def _start_question(self, question_number: int):
+        self._finish_question()
+        self._question_number = question_number
+
+    def _process_line(self, line: str):
+        i = 0
+        while i < len(line):
+            if self._state == "code":
+                i = self._process_code(line, i)
+            elif self._state == "block_comment":
+                i = self._process_block_comment(line, i)
+            elif self._state == "escape_quoted":
+                # رشته E'...' که در آن \' علامت پایان نیست
+                end = _escape_string_end(line, i)
+                if end == -1:
+                    self._append(line[i:], True)
+                    return
+                self._append(line[i:end], True)
+                self._state = "code"
+                i = end
+            else:
+                # رشته، شناسه نقل‌قول‌شده یا dollar-quoting تا رسیدن به علامت پایان
+                end = line.find(self._closing, i)
+                if end == -1:
+                    self._append(line[i:], True)
+                    return
+                end += len(self._closing)
+                if self._state == "quoted" and line.startswith(self._closing, end):
+                    # '' یا "" داخل رشته علامت پایان نیست
+                    self._append(line[i:end + 1], True)
+                    i = end + 1
+                    continue
+                self._append(line[i:end], True)
+                self._state = "code"
+                i = end
+
+    def _process_code(self, line: str, i: int) -> int:
+        char = line[i]
+        if line.startswith("--", i):
+            match = None if self._hash_markers else self._marker.match(line, i)
+            if match:
+                self._start_question(int(match.group(1)))
+            else:
+                self._append(line[i:], False)
+            return len(line)
+        if char == "#" and self._hash_markers:
+            match = self._marker.match(line, i)
+            if match:
+                self._start_question(int(match.group(1)))
+                return match.end()
+        if line.startswith("/*", i):
+            self._state = "block_comment"
+            self._block_depth = 1
+            self._append("/*", False)
+            return i + 2
+        if char == "'" and _has_escape_prefix(line, i):
+            self._state = "escape_quoted"
+            self._append(char, True)
+            return i + 1
+        if char in "'\"":
+            self._state = "quoted"
+            self._closing = char
+            self._append(char, True)
+            return i + 1
+        if char == "$":
+            match = _DOLLAR_TAG_PATTERN.match(line, i)
+            if match:
+                self._state = "dollar_quoted"
+                self._closing = match.group()
+                self._append(match.group(), True)
+                return match.end()
+        # بخش بعدی کد تا اولین کاراکتری که ممکن است شروع توکن خاص باشد
+        end = i + 1
+        while end < len(line) and line[end] not in "-/'\"$#":
+            end += 1
+        self._append_code(line[i:end])
+        return end
+
+    def _process_block_comment(self, line: str, i: int) -> int:
+        start = i
+        while i < len(line):
+            if line.startswith("/*", i):
+                self._block_depth += 1
+                i += 2
+            elif line.startswith("*/", i):
+                self._block_depth -= 1
+                i += 2
+                if self._block_depth == 0:
+                    self._state = "code"
+                    break
+            else:
+                i += 1
+        self._append(line[start:i], False)
+        return i
+
+def iter_submission(chunks, marker_style: str = None):
+    """تکه‌های متن ارسال را می‌گیرد و به محض کامل شدن هر سوال، (شماره سوال، کوئری) را برمی‌گرداند"""
+    splitter = SubmissionSplitter(marker_style)
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+    yield from splitter.close()
+
+def split_submission(sql_text: str) -> list:
+    """متن کامل ارسال را به لیست (شماره سوال، کوئری) تقسیم می‌کند"""
+    return list(iter_submission([sql_text]))
+
+def duplicate_question_numbers(questions: list) -> list:
+    """شماره سوال‌هایی که بیش از یک بار در ارسال آمده‌اند؛ نتیجه تکراری‌ها روی هم نوشته می‌شد"""
+    counts = Counter(question_number for question_number, _ in questions)
+    return sorted(question_number for question_number, count in counts.items() if count > 1)
+
+def reply_duplicate_questions(update: Update, duplicates: list):
+    update.message.reply_text(
+        "❌ شماره سوال " + ", ".join(map(str, duplicates)) + " بیش از یک بار در ارسال شما آمده است.\n\n"
+        "💡 هر سوال باید دقیقاً یک بار با نشانه -- #شماره شروع شود؛ کوئری‌های قبل از اولین نشانه سوال 1 حساب می‌شوند.\n"
+        "💻 لطفاً ارسال را اصلاح و دوباره ارسال کنید:",
+        reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+    )
+
+# ==================== دریافت فایل ارسال ====================
+
+# سقف حجم فایل .sql ارسالی (بایت)
+MAX_SQL_DOCUMENT_BYTES = int(os.environ.get("MAX_SQL_DOCUMENT_BYTES", str(1024 * 1024)))
+SQL_DOCUMENT_CHUNK_BYTES = int(os.environ.get("SQL_DOCUMENT_CHUNK_BYTES", "65536"))
+SQL_DOCUMENT_DOWNLOAD_TIMEOUT = int(os.environ.get("SQL_DOCUMENT_DOWNLOAD_TIMEOUT", "30"))
+# فایل‌هایی که UTF-8 معتبر نیستند با این encoding خوانده می‌شوند (ویندوز فارسی)
+SQL_DOCUMENT_FALLBACK_ENCODING = os.environ.get("SQL_DOCUMENT_FALLBACK_ENCODING", "cp1256")
+
+class SubmissionTooLarge(Exception):
+    """حجم فایل ارسال از MAX_SQL_DOCUMENT_BYTES بیشتر است"""
+
+def _iter_document_bytes(file):
+    """محتوای فایل تلگرام را تکه به تکه دانلود می‌کند و با عبور از سقف حجم متوقف می‌شود"""
+    received = 0
+    with urllib.request.urlopen(file.file_path, timeout=SQL_DOCUMENT_DOWNLOAD_TIMEOUT) as response:
+        while True:
+            chunk = response.read(SQL_DOCUMENT_CHUNK_BYTES)
+            if not chunk:
+                return
+            received += len(chunk)
+            if received > MAX_SQL_DOCUMENT_BYTES:
+                raise SubmissionTooLarge(f"{received} bytes")
+            yield chunk
+
+def _document_decoder(chunk):
+    """
+    encoding فایل را از اولین تکه غیر ASCII تعیین می‌کند: اگر این تکه UTF-8 معتبر نباشد کل فایل با
+    SQL_DOCUMENT_FALLBACK_ENCODING خوانده می‌شود، وگرنه UTF-8 و بایت‌های نامعتبر بعدی با U+FFFD جایگزین می‌شوند
+    """
+    try:
+        codecs.getincrementaldecoder("utf-8-sig")().decode(chunk)
+    except UnicodeDecodeError:
+        return codecs.getincrementaldecoder(SQL_DOCUMENT_FALLBACK_ENCODING)("replace")
+    return codecs.getincrementaldecoder("utf-8-sig")("replace")
+
+def read_sql_document(document: Document):
+    """
+    فایل .sql را به صورت جریانی دانلود و decode می‌کند و تکه‌ها را هم‌زمان به SubmissionSplitter می‌دهد.
+    (متن کامل ارسال، لیست (شماره سوال، کوئری)) برمی‌گرداند. BOM ابتدای فایل حذف می‌شود و encoding
+    یک بار برای کل فایل با _document_decoder انتخاب می‌شود.
+    """
+    if document.file_size and document.file_size > MAX_SQL_DOCUMENT_BYTES:
+        raise SubmissionTooLarge(f"{document.file_size} bytes")
+    
+    file = document.get_file()
+    decoder = None
+    splitter = SubmissionSplitter()
+    parts = []
+    questions = []
+    
+    for chunk in _iter_document_bytes(file):
+        if decoder is None:
+            if chunk.isascii():
+                # تکه‌های ASCII در هر دو encoding یکسان‌اند و تصمیم را به اولین تکه غیر ASCII می‌سپاریم
+                part = chunk.decode("ascii")
+                parts.append(part)
+                questions.extend(splitter.feed(part))
+                continue
+            decoder = _document_decoder(chunk)
+        part = decoder.decode(chunk)
+        parts.append(part)
+        questions.extend(splitter.feed(part))
+    
+    if decoder is not None:
+        part = decoder.decode(b"", final=True)
+        parts.append(part)
+        questions.extend(splitter.feed(part))
+    questions.extend(splitter.close())
+    return "".join(parts), questions
+
+def reply_document_too_large(update: Update):
+    update.message.reply_text(
+        f"❌ حجم فایل بیش از حد مجاز ({MAX_SQL_DOCUMENT_BYTES // 1024} کیلوبایت) است.\n"
+        "📝 لطفاً فقط کوئری‌های تمرین را در فایل قرار دهید و دوباره ارسال کنید:",
+        reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+    )
+
+def reply_document_download_failed(update: Update, error: Exception):
+    print(f"Error downloading submission document: {error}")
+    update.message.reply_text(
+        "⚠️ خطا در دریافت فایل!\n"
+        "🔄 لطفاً دوباره ارسال کنید:",
+        reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+    )
+
+# ==================== ثبت دسته‌ای نتایج (write-behind) ====================
+
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", "50"))
+# حداکثر تأخیر ثبت یک ردیف در دیتابیس (ثانیه)
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get("WRITE_BEHIND_FLUSH_INTERVAL", "0.25"))
+# ردیف‌ها پیش از اعلام نتیجه به دانشجو در این فایل نوشته و هنگام راه‌اندازی بعدی دوباره ثبت می‌شوند.
+# هر پردازه با قفل فایل اولین journal آزاد (write_behind.journal، write_behind.journal.1، ...) را برمی‌دارد
+WRITE_BEHIND_JOURNAL = os.environ.get("WRITE_BEHIND_JOURNAL", "write_behind.journal")
+# بدون fsync، journal فقط در برابر kill شدن پردازه امن است و نه قطع برق سرور
+WRITE_BEHIND_FSYNC = os.environ.get("WRITE_BEHIND_FSYNC", "0") == "1"
+
+_WRITE_BEHIND_COLUMNS = {
+    "student_results": ("student_id", "name", "major", "hw", "correct_count", "sql_queries", "question_outcomes"),
+    "teacher_queries": ("student_id", "student_name", "major", "query", "output"),
+}
+
+def _write_behind_insert(table: str):
+    columns = _WRITE_BEHIND_COLUMNS[table] + ("submission_time", "submission_uid")
+    # submission_uid تکراری یعنی این ردیف قبلاً ثبت شده و از journal دوباره خوانده شده است
+    return text(
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join(':' + column for column in columns)}) "
+        "ON CONFLICT (submission_uid) DO NOTHING"
+    )
+
+def _write_behind_params(row: dict) -> dict:
+    return dict(row, submission_time=datetime.fromisoformat(row["submission_time"]))
+
+class WriteBehindBuffer:
+    """
+    ردیف‌های student_results و teacher_queries را جمع می‌کند و هر WRITE_BEHIND_FLUSH_INTERVAL
+    ثانیه یا با رسیدن به WRITE_BEHIND_BATCH_SIZE ردیف، همه را در یک تراکنش ثبت می‌کند.
+    هر ردیف قبل از add برگشتن در journal نوشته می‌شود و journal پس از هر ثبت موفق
+    به ردیف‌های هنوز ثبت‌نشده کوتاه می‌شود. چند پردازه (مثلاً چند نسخه ربات در یک پوشه) هر کدام
+    journal قفل‌شده خود را دارند و journal نسخه‌هایی که از کار افتاده‌اند هنگام start برداشته می‌شود.
+    """
+
+    def __init__(self, journal_path: str):
+        self.base_journal_path = journal_path
+        self.journal_path = journal_path
+        self._journal_lock = None
+        self._pending = []
+        self._condition = Condition()
+        self._journal = None
+        self._thread = None
+        self._stopping = False
+        self._flush_requested = False
+
+    def add(self, table: str, row: dict):
+        row = dict(row, submission_time=datetime.now(pytz.utc).isoformat(), submission_uid=uuid.uuid4().hex)
+        with self._condition:
+            self._write_journal_line(table, row)
+            self._pending.append((table, row))
+            if len(self._pending) >= WRITE_BEHIND_BATCH_SIZE:
+                self._condition.notify_all()
+
+    def _write_journal_line(self, table: str, row: dict):
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal.write(json.dumps({"table": table, "row": row}, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        if WRITE_BEHIND_FSYNC:
+            os.fsync(self._journal.fileno())
+
+    def _compact_journal(self):
+        """journal را با ردیف‌های هنوز ثبت‌نشده بازنویسی می‌کند (باید با قفل فراخوانی شود)"""
+        if self._journal is not None:
+            self._journal.close()
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as journal:
+            for table, row in self._pending:
+                journal.write(json.dumps({"table": table, "row": row}, ensure_ascii=False) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temp_path, self.journal_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def _journal_slots(self) -> list:
+        """مسیر همه journalهای موجود کنار journal اصلی (بدون فایل‌های lock، tmp و rejected)"""
+        slot_pattern = re.compile(re.escape(self.base_journal_path) + r"(\.\d+)?")
+        paths = glob.glob(glob.escape(self.base_journal_path) + "*")
+        return sorted(path for path in paths if slot_pattern.fullmatch(path))
+
+    @staticmethod
+    def _try_lock(path: str):
+        """قفل انحصاری journal را بدون انتظار می‌گیرد؛ اگر پردازه دیگری آن را دارد None برمی‌گرداند"""
+        lock_file = open(path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _acquire_journal(self):
+        for slot in itertools.count():
+            path = self.base_journal_path if slot == 0 else f"{self.base_journal_path}.{slot}"
+            lock_file = self._try_lock(path)
+            if lock_file is not None:
+                self.journal_path = path
+                self._journal_lock = lock_file
+                return
+
+    def _read_journal(self, path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        replayed = 0
+        with open(path, encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # خط آخر ممکن است هنگام kill شدن پردازه نیمه‌کاره مانده باشد
+                self._pending.append((entry["table"], entry["row"]))
+                replayed += 1
+        return replayed
+
+    def _replay_journal(self) -> int:
+        """ردیف‌های journal خود و journalهای بدون صاحب (پردازه‌هایی که دیگر اجرا نمی‌شوند) را در صف می‌گذارد"""
+        replayed = self._read_journal(self.journal_path)
+        orphans = []
+        for path in self._journal_slots():
+            if path == self.journal_path:
+                continue
+            lock_file = self._try_lock(path)
+            if lock_file is None:
+                continue
+            replayed += self._read_journal(path)
+            orphans.append((path, lock_file))
+        if orphans:
+            # ردیف‌ها پیش از حذف journalهای قبلی در journal این پردازه نوشته می‌شوند
+            self._compact_journal()
+            for path, lock_file in orphans:
+                os.remove(path)
+                lock_file.close()
+        return replayed
+
+    def start(self):
+        """ردیف‌های باقی‌مانده از اجرای قبلی را دوباره در صف می‌گذارد و thread ثبت را راه‌اندازی می‌کند"""
+        if self._thread is not None:
+            return
+        with self._condition:
+            self._acquire_journal()
+            replayed = self._replay_journal()
+        if replayed:
+            print(f"Replaying {replayed} buffered rows from {self.journal_path}")
+        self._thread = Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def flush(self, timeout: float = None) -> bool:
+        """تا ثبت همه ردیف‌های در انتظار صبر می‌کند"""
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: not self._pending, timeout=timeout)
+
+    def stop(self, timeout: float = 10):
+        self.flush(timeout)
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        retry_delay = WRITE_BEHIND_FLUSH_INTERVAL
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._stopping or self._flush_requested or len(self._pending) >= WRITE_BEHIND_BATCH_SIZE,
+                    timeout=WRITE_BEHIND_FLUSH_INTERVAL
+                )
+                batch = self._pending[:WRITE_BEHIND_BATCH_SIZE]
+                if not batch:
+                    self._flush_requested = False
+                    if self._stopping:
+                        return
+                    continue
             
-            # ارسال پیام اطلاع‌رسانی به ادمین
-            persian_date, persian_time = get_persian_datetime()
-            admin_message = (
-                "🔔 اطلاع‌رسانی ثبت/ویرایش ایمیل\n\n"
-                f"👤 دانشجو: {context.user_data['name']}\n"
-                f"🆔 شماره دانشجویی: {student_id}\n"
-                f"📚 رشته: {context.user_data['major']}\n"
-                f"📧 ایمیل جدید: {new_email}\n"
-                f"📅 تاریخ: {persian_date}\n"
-                f"🕐 ساعت: {persian_time}"
-            )
-            send_notification_to_admin(context, admin_message)
+            try:
+                self._write_batch(batch)
+                retry_delay = WRITE_BEHIND_FLUSH_INTERVAL
+            except OperationalError as e:
+                # دیتابیس در دسترس نیست؛ ردیف‌ها در journal می‌مانند و دوباره تلاش می‌شود
+                print(f"Error writing {len(batch)} buffered rows: {e}")
+                if self._stopping:
+                    return
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 30)
+                continue
+            except Exception as e:
+                print(f"Error writing {len(batch)} buffered rows, retrying one by one: {e}")
+                self._write_rows_individually(batch)
             
+            with self._condition:
+                # فقط همین thread از ابتدای صف برمی‌دارد، پس batch هنوز ابتدای _pending است
+                del self._pending[:len(batch)]
+                self._compact_journal()
+                self._condition.notify_all()
+
+    def _write_batch(self, batch: list):
+        with engine.begin() as conn:
+            for table in _WRITE_BEHIND_COLUMNS:
+                rows = [_write_behind_params(row) for row_table, row in batch if row_table == table]
+                if rows:
+                    conn.execute(_write_behind_insert(table), rows)
+
+    def _write_rows_individually(self, batch: list):
+        """ردیف‌هایی که حتی به تنهایی ثبت نمی‌شوند در فایل rejected کنار journal نگه داشته می‌شوند"""
+        for table, row in batch:
+            try:
+                with engine.begin() as conn:
+                    conn.execute(_write_behind_insert(table), _write_behind_params(row))
+            except Exception as e:
+                print(f"Error writing buffered {table} row {row['submission_uid']}: {e}")
+                with open(self.journal_path + ".rejected", "a", encoding="utf-8") as rejected:
+                    rejected.write(json.dumps({"table": table, "row": row, "error": str(e)}, ensure_ascii=False) + "\n")
+
+result_writer = WriteBehindBuffer(WRITE_BEHIND_JOURNAL)
+
+# ==================== صف تصحیح ====================
+
+GRADING_QUEUE_SIZE = int(os.environ.get("GRADING_QUEUE_SIZE", "100"))
+GRADING_QUEUE_WORKERS = int(os.environ.get("GRADING_QUEUE_WORKERS", "4"))
+
+grading_queue = Queue(maxsize=GRADING_QUEUE_SIZE)
+
+def _grading_worker():
+    while True:
+        job = grading_queue.get()
+        try:
+            process_sql(job["update"], job["context"], job["sql_text"], job["submission"], job["questions"])
+        except Exception as e:
+            print(f"Error grading submission of {job['submission']['student_id']}: {e}")
+            reply_grading_failed(job["update"])
+        finally:
+            grading_queue.task_done()
+
+def reply_grading_failed(update: Update):
+    try:
+        update.message.reply_text(
+            "⚠️ خطا در تصحیح ارسال شما!\n"
+            "🔄 لطفاً دوباره تلاش کنید.",
+            reply_markup=get_main_menu()
+        )
+    except Exception as reply_error:
+        print(f"Error sending grading failure message: {reply_error}")
+    finish_grading(update.message.chat_id)
+
+def start_grading_workers():
+    """کارگرهای صف تصحیح را راه‌اندازی می‌کند"""
+    for i in range(GRADING_QUEUE_WORKERS):
+        Thread(target=_grading_worker, name=f"grading-queue-{i}", daemon=True).start()
+
+def enqueue_submission(update: Update, context: CallbackContext, sql_text: str, questions: list = None):
+    """
+    ارسال دانشجو را در صف تصحیح قرار می‌دهد و جایگاه آن در صف را به دانشجو اعلام می‌کند.
+    questions سوال‌هایی است که هنگام دریافت فایل جدا شده‌اند تا متن دوباره تقسیم نشود.
+    """
+    chat_id = update.message.chat_id
+    questions = questions if questions is not None else split_submission(sql_text)
+    duplicates = duplicate_question_numbers(questions)
+    if duplicates:
+        reply_duplicate_questions(update, duplicates)
+        return
+    
+    # اطلاعات لحظه ارسال ذخیره می‌شود تا تغییر منو در حین انتظار روی تصحیح اثر نگذارد
+    submission = {key: context.user_data[key] for key in ("hw", "name", "student_id", "major")}
+    job = {"update": update, "context": context, "sql_text": sql_text, "submission": submission, "questions": questions}
+    
+    if grading_queue.full():
+        reply_grading_queue_full(update)
+        return
+    
+    # وضعیت و پیام صف پیش از قرار گرفتن در صف ثبت می‌شوند؛ وگرنه کارگری که زودتر تمام کند
+    # وضعیت completed را با grading بازنویسی می‌کند و پیام صف بعد از نتیجه می‌رسد
+    user_state[chat_id] = "grading"
+    reply_submission_queued(update, grading_queue.qsize() + 1)
+    try:
+        grading_queue.put_nowait(job)
+    except Full:
+        user_state[chat_id] = "waiting_sql"
+        reply_grading_queue_full(update)
+
+def reply_grading_queue_full(update: Update):
+    update.message.reply_text(
+        "🚦 صف تصحیح در حال حاضر پر است.\n"
+        "⏳ لطفاً چند دقیقه دیگر دوباره ارسال کنید.",
+        reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+    )
+
+def reply_submission_queued(update: Update, position: int):
+    update.message.reply_text(
+        "📥 ارسال شما دریافت شد و در صف تصحیح قرار گرفت.\n\n"
+        f"🔢 جایگاه شما در صف: {position}\n"
+        "⏳ نتیجه پس از تصحیح برای شما ارسال می‌شود."
+    )
+
+def reserve_submission_attempt(conn, student_id: str, hw: str):
+    """
+    شمارنده ارسال‌های دانشجو را با یک دستور اتمی فقط در صورتی که به سقف نرسیده باشد افزایش می‌دهد؛
+    تعداد ارسال‌ها با احتساب ارسال جدید، یا در صورت رسیدن به سقف None برمی‌گرداند.
+    """
+    row = conn.execute(
+        text("""
+            INSERT INTO submission_counters (student_id, hw, attempts)
+            VALUES (:student_id, :hw, 1)
+            ON CONFLICT (student_id, hw) DO UPDATE
+            SET attempts = submission_counters.attempts + 1
+            WHERE submission_counters.attempts < :max_submissions
+            RETURNING attempts
+        """),
+        {"student_id": student_id, "hw": hw, "max_submissions": MAX_SUBMISSIONS}
+    ).fetchone()
+    return row[0] if row else None
+
+def release_submission_attempt(conn, student_id: str, hw: str):
+    """ارسالی که پس از رزرو در تراکنش جدا تصحیح یا ثبت نشد از شمارنده کم می‌شود"""
+    conn.execute(
+        text("UPDATE submission_counters SET attempts = attempts - 1 WHERE student_id = :student_id AND hw = :hw AND attempts > 0"),
+        {"student_id": student_id, "hw": hw}
+    )
+
+def finish_grading(chat_id):
+    """پس از پایان تصحیح، اگر دانشجو در این فاصله به بخش دیگری نرفته باشد او را به منو اصلی برمی‌گرداند"""
+    if user_state.get(chat_id) in ("grading", "waiting_sql"):
+        user_state[chat_id] = "completed"
+
+def _submission_result_row(submission: dict, sql_text: str, outcomes: dict) -> dict:
+    correct_count = sum(1 for outcome in outcomes.values() if outcome == OUTCOME_CORRECT)
+    return {"student_id": submission["student_id"], "name": submission["name"], "major": submission["major"], "hw": submission["hw"], "correct_count": correct_count, "sql_queries": sql_text, "question_outcomes": json.dumps(outcomes)}
+
+def _reply_storage_error(update: Update, error: Exception):
+    print(f"❌ Error inserting data: {error}")
+    update.message.reply_text(f"⚠️ خطا در ذخیره‌سازی: {str(error)}", reply_markup=get_main_menu())
+    finish_grading(update.message.chat_id)
+
+def process_sql(update: Update, context: CallbackContext, sql_text: str, submission: dict = None, questions: list = None):
+    submission = submission or context.user_data
+    questions = questions if questions is not None else iter_submission([sql_text])
+    
+    try:
+        with engine.begin() as conn:
+            # قفل ردیف شمارنده تا پایان این تراکنش ارسال هم‌زمان دیگر همین دانشجو را منتظر نگه می‌دارد
+            # و اگر تصحیح یا ذخیره‌سازی با خطا مواجه شود، شمارنده هم به حالت قبل برمی‌گردد
+            new_submission_count = reserve_submission_attempt(conn, submission["student_id"], submission["hw"])
+            outcomes = {}
+            if new_submission_count is not None:
+                outcomes = grade_submission(submission["hw"], submission["major"], questions)
+        if new_submission_count is not None:
+            # ردیف نتیجه پیش از اعلام به دانشجو در journal نوشته و به صورت دسته‌ای ثبت می‌شود
+            result_writer.add("student_results", _submission_result_row(submission, sql_text, outcomes))
+    except Exception as e:
+        _reply_storage_error(update, e)
+        return
+    
+    send_grading_result(update, submission, outcomes, new_submission_count)
+
+def send_grading_result(update: Update, submission: dict, outcomes: dict, new_submission_count):
+    """نتیجه تصحیح (یا پیام رسیدن به سقف ارسال) را برای دانشجو می‌فرستد و پروفایل کش‌شده را به‌روز می‌کند"""
+    chat_id = update.message.chat_id
+    hw = submission["hw"]
+    name = submission["name"]
+    student_id = submission["student_id"]
+    major = submission["major"]
+    
+    if new_submission_count is None:
+        update_cached_profile(student_id, hw=hw, submission_count=MAX_SUBMISSIONS)
+        with outbound_lane(OUTBOUND_LANE_GRADING_RESULT):
             update.message.reply_text(
-                "✅ ایمیل با موفقیت ثبت/به‌روزرسانی شد!\n\n"
-                f"📧 ایمیل شما: {new_email}\n\n"
-                "📢 از این پس اطلاع‌رسانی‌های مهم به این ایمیل ارسال می‌شود.\n"
-                "🔄 می‌توانید هر زمان آن را تغییر دهید.\n\n"
-                "🏠 بازگشت به منو اصلی:",
+                f"❌ شما قبلاً ۱۰ بار تمرین {hw} را ارسال کرده‌اید و حق ارسال مجدد ندارید.",
                 reply_markup=get_main_menu()
             )
+        finish_grading(chat_id)
+        return
+    
+    correct_count = sum(1 for outcome in outcomes.values() if outcome == OUTCOME_CORRECT)
+    update_cached_profile(student_id, hw=hw, submission_count=new_submission_count)
+    print(f"✅ Data inserted successfully for {name} ({student_id}) - Major: {major} - HW{hw}: {correct_count} correct")
+    
+    incorrect_questions = [question_number for question_number, outcome in outcomes.items() if outcome != OUTCOME_CORRECT]
+    timed_out_questions = [question_number for question_number, outcome in outcomes.items() if outcome == OUTCOME_TIMEOUT]
+    too_large_questions = [question_number for question_number, outcome in outcomes.items() if outcome == OUTCOME_TOO_LARGE]
+    
+    persian_date, persian_time = get_persian_datetime()
+    
+    result_message = f"🎉 تصحیح با موفقیت انجام شد!\n\n"
+    result_message += f"┌─────────────────────────────\n"
+    result_message += f"│ 📅 تاریخ: {persian_date}\n"
+    result_message += f"│ 🕐 ساعت: {persian_time}\n"
+    result_message += f"├─────────────────────────────\n"
+    result_message += f"│ 👤 دانشجو: {name}\n"
+    result_message += f"│ 🆔 شماره دانشجویی: {student_id}\n"
+    result_message += f"│ 📚 رشته: {major}\n"
+    result_message += f"│ 📝 تمرین: {hw}\n"
+    result_message += f"└─────────────────────────────\n\n"
+    result_message += f"📊 نتیجه: {correct_count}/{len(outcomes)} سوال درست است.\n\n"
+    
+    if major == "آمار":
+        email_address = "hw@statdb.ir"
+    else:
+        email_address = "hw@dbcs.ir"
+    
+    result_message += f"📧 لطفاً از این پیام اسکرین شات بگیرید و با عنوانی که پیش‌تر توضیح داده شده و تمرین‌های قبلی را ارسال می‌کردید به آدرس:\n"
+    result_message += f"✉️ {email_address}\n\n"
+    
+    if incorrect_questions:
+        result_message += "❌ سوال‌های نادرست: " + ", ".join(map(str, incorrect_questions)) + "\n\n"
+        if timed_out_questions:
+            result_message += "⏱️ سوال‌هایی که زمان اجرایشان از سقف مجاز بیشتر شد: " + ", ".join(map(str, timed_out_questions)) + "\n\n"
+        if too_large_questions:
+            result_message += "📦 سوال‌هایی که تعداد ردیف‌های خروجی‌شان بیش از حد مجاز بود: " + ", ".join(map(str, too_large_questions)) + "\n\n"
+    else:
+        result_message += "🏆 تبریک! تمام سوال‌ها صحیح است!\n\n"
+    
+    remaining_attempts = MAX_SUBMISSIONS - new_submission_count
+    result_message += f"📈 ارسال‌های انجام شده: {new_submission_count}/10\n"
+    result_message += f"📊 ارسال‌های باقی‌مانده: {remaining_attempts}\n\n"
+    
+    if remaining_attempts == 0:
+        result_message += "⚠️ این آخرین ارسال شما برای این تمرین بود.\n\n"
+    
+    result_message += "🤔 آیا می‌خواهید تمرین جدیدی ثبت کنید؟"
+    
+    with outbound_lane(OUTBOUND_LANE_GRADING_RESULT):
+        update.message.reply_text(result_message, reply_markup=get_main_menu())
+    finish_grading(chat_id)
+
+def process_classroom_sql(update: Update, context: CallbackContext, sql_text: str):
+    # ذخیره کوئری در context برای استفاده بعدی
+    context.user_data["last_query"] = sql_text
+    
+    if not is_query_allowed(sql_text):
+        reply_query_not_allowed(update)
+        return
+    
+    try:
+        with classroom_engine.begin() as conn:
+            columns, rows = fetch_classroom_rows(conn, sql_text)
+    except Exception as e:
+        reply_classroom_error(update, e)
+        return
+    
+    reply_classroom_result(update, context, columns, rows)
+
+def fetch_classroom_rows(conn, sql_text: str):
+    """کوئری سرکلاسی را با محدودیت منابع اجرا و (ستون‌ها، ردیف‌ها) را برمی‌گرداند"""
+    apply_resource_limits(conn, "classroom")
+    max_rows = MAX_RESULT_ROWS["classroom"]
+    result = conn.execute(text(sql_text), execution_options={"yield_per": FINGERPRINT_BATCH_SIZE})
+    rows = result.fetchmany(max_rows + 1) if max_rows else result.fetchall()
+    if max_rows and len(rows) > max_rows:
+        result.close()
+        raise QueryTooLarge(f"query returned more than {max_rows} rows")
+    return list(result.keys()), rows
+
+def reply_query_not_allowed(update: Update):
+    # دریافت لیست جدول‌های مجاز برای نمایش به کاربر
+    allowed_tables = get_allowed_tables()
+    tables_list = "\n".join([f"• {table}" for table in sorted(allowed_tables)])
+    
+    update.message.reply_text(
+        f"❌ کوئری شما مجاز نیست!\n\n"
+        f"✅ جدول‌های مجاز:\n{tables_list}\n\n"
+        "⚠️ محدودیت‌ها:\n"
+        "• فقط دستورات SELECT مجاز هستند\n"
+        "• فقط می‌توانید از جدول‌های بالا استفاده کنید\n"
+        "• دستورات INSERT, UPDATE, DELETE, DROP, CREATE, ALTER ممنوع هستند\n"
+        "• سایر جدول‌ها غیرقابل دسترسی هستند\n\n"
+        "💻 لطفاً یک کوئری SELECT معتبر ارسال کنید:",
+        reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+    )
+
+def reply_classroom_result(update: Update, context: CallbackContext, columns: list, rows: list):
+    chat_id = update.message.chat_id
+    
+    # ذخیره خروجی برای ارسال احتمالی به مدرس
+    output_data = {
+        "columns": columns,
+        "rows": [list(row) for row in rows[:100]],  # محدودیت برای جلوگیری از حجم زیاد
+        "total_rows": len(rows)
+    }
+    context.user_data["last_output"] = json.dumps(output_data, default=str)
+    
+    if rows:
+        result_message = "✅ نتایج اجرای کوئری:\n\n"
+        result_message += "┌" + "─" * 50 + "┐\n"
+    
+        header = "│ " + " | ".join(str(col)[:15].ljust(15) for col in columns) + " │"
+        result_message += header + "\n"
+        result_message += "├" + "─" * 50 + "┤\n"
+    
+        for i, row in enumerate(rows[:10]):
+            row_str = "│ " + " | ".join(str(val)[:15].ljust(15) for val in row) + " │"
+            result_message += row_str + "\n"
+    
+        result_message += "└" + "─" * 50 + "┘\n\n"
+    
+        if len(rows) > 10:
+            result_message += f"📊 نمایش 10 ردیف اول از {len(rows)} ردیف\n\n"
+    
+    else:
+        result_message = "✅ کوئری با موفقیت اجرا شد اما هیچ نتیجه‌ای بازنگشت.\n\n"
+    
+    # اضافه کردن گزینه ارسال به مدرس
+    result_message += "📤 آیا می‌خواهید این کوئری را برای بررسی به مدرس ارسال کنید?"
+    
+    # ایجاد کیبورد با گزینه‌های جدید
+    keyboard = [
+        ["✅ بله، ارسال به مدرس"],
+        ["❌ خیر، فقط نمایش"],
+        ["🔙 بازگشت به منو اصلی"]
+    ]
+    
+    update.message.reply_text(
+        result_message,
+        reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
+    )
+    
+    # تغییر state برای مدیریت پاسخ کاربر
+    user_state[chat_id] = "waiting_teacher_submission_decision"
+
+def reply_classroom_error(update: Update, error: Exception):
+    chat_id = update.message.chat_id
+    
+    if isinstance(error, QueryTooLarge):
+        error_message = f"📦 خروجی کوئری بیش از {MAX_RESULT_ROWS['classroom']} ردیف است و اجرای آن متوقف شد.\n\n"
+        error_message += "💻 لطفاً با WHERE یا LIMIT خروجی را محدود کنید و مجدداً ارسال کنید:"
+        
+        update.message.reply_text(
+            error_message,
+            reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+        )
+        user_state[chat_id] = "waiting_classroom_sql"
+        return
+    
+    if is_statement_timeout(error):
+        error_message = f"⏱️ اجرای کوئری بیش از {STATEMENT_TIMEOUT_MS['classroom'] // 1000} ثانیه طول کشید و متوقف شد.\n\n"
+    else:
+        error_message = f"❌ خطا در اجرای کوئری:\n\n{str(error)}\n\n"
+    error_message += "💻 لطفاً کوئری خود را بررسی و مجدداً ارسال کنید:"
+    
+    update.message.reply_text(
+        error_message,
+        reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+    )
+    user_state[chat_id] = "waiting_classroom_sql"
+
+# ==================== اجرای asyncio ====================
+
+# threads: هندلرهای همگام و صف تصحیح با thread کارگر
+# asyncio: تصحیح و کوئری‌های سرکلاسی روی یک حلقه asyncio با درایور asyncpg
+RUNTIME_MODE = os.environ.get("RUNTIME_MODE", "threads")
+# حداکثر تعداد ارسال‌هایی که هم‌زمان روی حلقه تصحیح می‌شوند؛ بقیه تا آزاد شدن جا منتظر می‌مانند
+ASYNC_GRADING_CONCURRENCY = int(os.environ.get("ASYNC_GRADING_CONCURRENCY", "200"))
+# threadهای فراخوانی‌های مسدودکننده (ارسال پیام تلگرام و مراحل کم‌تکرار منو)
+ASYNC_BLOCKING_WORKERS = int(os.environ.get("ASYNC_BLOCKING_WORKERS", "16"))
+
+class AsyncRuntime:
+    """
+    حلقه asyncio در یک thread جداگانه که هندلرهای async روی آن اجرا می‌شوند.
+    python-telegram-bot 13 هندلر async ندارد؛ dispatch هر هندلر async را به callback
+    همگامی تبدیل می‌کند که فقط coroutine را روی حلقه زمان‌بندی می‌کند.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.engine = None
+        self.grading_engine = None
+        self.classroom_engine = None
+        self.grading_slots = None
+        self.grading_connections = None
+        self.waiting_gradings = 0
+        self._chat_locks = {}
+        self._tasks = set()
+
+    def start(self):
+        if self.loop is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_BLOCKING_WORKERS, thread_name_prefix="async-blocking"))
+        Thread(target=self.loop.run_forever, name="asyncio-runtime", daemon=True).start()
+        self.submit(self._setup()).result()
+
+    async def _setup(self):
+        self.engine = create_async_pooled_engine("BOOKKEEPING", DB_URI)
+        self.grading_engine = create_async_pooled_engine("GRADING", CLASSROOM_DB_URI)
+        self.classroom_engine = create_async_pooled_engine("CLASSROOM", CLASSROOM_DB_URI)
+        self.grading_slots = asyncio.Semaphore(ASYNC_GRADING_CONCURRENCY)
+        # تصحیح‌های بیش از ظرفیت pool به جای خطای pool_timeout در این صف منتظر اتصال می‌مانند
+        grading_capacity = _pool_setting("GRADING", "SIZE", "5") + _pool_setting("GRADING", "MAX_OVERFLOW", "10")
+        self.grading_connections = asyncio.Semaphore(grading_capacity)
+        if ASYNC_GRADING_CONCURRENCY * max(GRADING_PARALLELISM, 1) > grading_capacity:
+            print(f"Only {grading_capacity} of {ASYNC_GRADING_CONCURRENCY} concurrent gradings can hold a "
+                  f"connection at once; raise GRADING_DB_POOL_SIZE/GRADING_DB_POOL_MAX_OVERFLOW to grade more in parallel")
+
+    def submit(self, coroutine):
+        """coroutine را از هر thread روی حلقه زمان‌بندی می‌کند و concurrent.futures.Future برمی‌گرداند"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def spawn(self, coroutine):
+        """task پس‌زمینه روی حلقه می‌سازد و تا پایانش ارجاع آن را نگه می‌دارد"""
+        task = self.loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """فراخوانی مسدودکننده را در thread pool اجرا می‌کند تا حلقه آزاد بماند"""
+        return await self.loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+    def dispatch(self, handler):
+        def callback(update: Update, context: CallbackContext):
+            self.submit(self._run_handler(handler, update, context))
+        return callback
+
+    async def _run_handler(self, handler, update: Update, context: CallbackContext):
+        # پیام‌های هر چت به ترتیب رسیدن و چت‌های مختلف هم‌زمان پردازش می‌شوند؛ قفل هر چت با تعداد
+        # پیام‌های در حال پردازش یا منتظر آن نگه داشته و با رسیدن به صفر حذف می‌شود
+        chat_id = update.effective_chat.id
+        chat_entry = self._chat_locks.get(chat_id)
+        if chat_entry is None:
+            chat_entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        chat_entry[1] += 1
+        try:
+            async with chat_entry[0]:
+                try:
+                    await handler(update, context)
+                except Exception as e:
+                    print(f"Error in async handler {handler.__name__}: {e}")
+        finally:
+            chat_entry[1] -= 1
+            if chat_entry[1] == 0:
+                del self._chat_locks[chat_id]
+
+async_runtime = AsyncRuntime()
+
+async def call_user_state(method, *args):
+    """
+    متد user_state را از روی حلقه فراخوانی می‌کند. با backend خارجی، کش منقضی‌شده از Postgres/Redis
+    خوانده می‌شود و این رفت‌وبرگشت همگام نباید حلقه را مسدود کند؛ در حالت memory مستقیم اجرا می‌شود.
+    """
+    if user_state.backend is None:
+        return method(*args)
+    return await async_runtime.run_blocking(method, *args)
+
+async def async_stream_fingerprint(conn, query: str, max_rows: int = 0):
+    """معادل async تابع stream_fingerprint؛ هش هر دسته از ردیف‌ها در thread pool محاسبه می‌شود"""
+    result = await conn.stream(text(query), execution_options={"yield_per": FINGERPRINT_BATCH_SIZE})
+    row_count = 0
+    digest = 0
+    async for batch in result.partitions():
+        row_count += len(batch)
+        if max_rows and row_count > max_rows:
+            await result.close()
+            raise QueryTooLarge(f"query returned more than {max_rows} rows")
+        digest = (digest + await async_runtime.run_blocking(_partition_digest, batch)) % _FINGERPRINT_MODULUS
+    return row_count, digest
+
+def _load_reference_fingerprint_on_own_connection(hw: str, question_number: int, major: str):
+    with grading_engine.connect() as conn:
+        return load_reference_fingerprint(conn, hw, question_number, major)
+
+async def async_grade_question(conn, hw: str, question_number: int, major: str, student_query: str) -> str:
+    """
+    معادل async تابع grade_question. فقط کوئری دانشجو روی اتصال async اجرا می‌شود؛ اثرانگشت مرجعی
+    که در کش نیست با اتصال همگام در thread pool خوانده (و در حالت server ساخته) می‌شود.
+    """
+    max_rows = MAX_RESULT_ROWS["grading"]
+    async with conn.begin_nested():
+        if GRADING_MODE == "server":
+            row = (await conn.execute(_server_fingerprint_sql(student_query))).fetchone()
+            student_fingerprint = (int(row[0]), int(row[1]))
+            if max_rows and student_fingerprint[0] > max_rows:
+                raise QueryTooLarge(f"query returned more than {max_rows} rows")
         else:
-            update.message.reply_text(
-                "❌ خطا در ثبت ایمیل!\n"
-                "🔄 لطفاً دوباره تلاش کنید یا با پشتیبانی تماس بگیرید.\n\n"
-                "🏠 بازگشت به منو اصلی:",
-                reply_markup=get_main_menu()
-            )
-            user_state[chat_id] = "completed"
+            student_fingerprint = await async_stream_fingerprint(conn, student_query, max_rows)
+    reference_fingerprint = reference_cache.get((hw, question_number, major))
+    if reference_fingerprint is None:
+        reference_fingerprint = await async_runtime.run_blocking(
+            _load_reference_fingerprint_on_own_connection, hw, question_number, major
+        )
+    return OUTCOME_CORRECT if student_fingerprint == reference_fingerprint else OUTCOME_INCORRECT
 
-def handle_document(update: Update, context: CallbackContext):
-    chat_id = update.message.chat_id
+async def _async_grade_question_safely(conn, hw: str, question_number: int, major: str, student_query: str) -> str:
+    try:
+        return await async_grade_question(conn, hw, question_number, major, student_query)
+    except Exception as e:
+        return _grading_error_outcome(question_number, e)
+
+async def _grade_question_async(hw: str, question_number: int, major: str, student_query: str, deadline=None) -> str:
+    async with async_runtime.grading_connections:
+        async with async_runtime.grading_engine.begin() as conn:
+            await conn.run_sync(apply_resource_limits, "grading")
+            await conn.run_sync(apply_question_deadline, deadline)
+            return await _async_grade_question_safely(conn, hw, question_number, major, student_query)
+
+async def async_grade_submission(hw: str, major: str, questions) -> dict:
+    """
+    معادل async تابع grade_submission؛ کوئری‌ها روی اتصال‌های asyncpg اجرا می‌شوند و
+    سوال‌هایی که تا پایان بودجه زمانی تمام نشوند واقعاً لغو می‌شوند.
+    """
+    deadline = time.monotonic() + GRADING_TIME_BUDGET if GRADING_TIME_BUDGET > 0 else None
+    results = {}
+    memo_keys = {}
+    pending = _pending_questions(questions, hw, major, results, memo_keys)
+    graded = []
     
-    if user_state.get(chat_id) == "waiting_sql":
-        document: Document = update.message.document
-        if not document.file_name.endswith(".sql"):
-            update.message.reply_text(
-                "❌ لطفاً یک فایل معتبر .sql ارسال کنید.\n\n"
-                "یا برای بازگشت به منو اصلی دکمه زیر را بزنید:",
-                reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
-            )
-            return
+    if GRADING_PARALLELISM <= 1:
+        async with async_runtime.grading_connections:
+            async with async_runtime.grading_engine.begin() as conn:
+                await conn.run_sync(apply_resource_limits, "grading")
+                for question_number, student_query in pending:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        print(f"Grading budget exceeded before question {question_number}")
+                        continue
+                    await conn.run_sync(apply_question_deadline, deadline)
+                    results[question_number] = await _async_grade_question_safely(conn, hw, question_number, major, student_query)
+                    graded.append(question_number)
+    else:
+        fan_out = asyncio.Semaphore(GRADING_PARALLELISM)
         
-        file = document.get_file()
-        sql_text = file.download_as_bytearray().decode("utf-8")
-        process_sql(update, context, sql_text)
+        async def grade_one(question_number, student_query):
+            async with fan_out:
+                return await _grade_question_async(hw, question_number, major, student_query, deadline)
+        
+        tasks = {asyncio.ensure_future(grade_one(question_number, student_query)): question_number
+                 for question_number, student_query in pending}
+        if tasks:
+            done, not_done = await asyncio.wait(tasks, timeout=_remaining_time(deadline))
+            for task in not_done:
+                task.cancel()
+                print(f"Grading budget exceeded for question {tasks[task]}")
+            for task in done:
+                results[tasks[task]] = task.result()
+                graded.append(tasks[task])
     
-    elif user_state.get(chat_id) == "waiting_classroom_sql":
-        update.message.reply_text(
-            "❌ در حالت اجرای کدهای تمرین‌های سرکلاسی، فقط ارسال متن مستقیم مجاز است.\n"
-            "💻 لطفاً کوئری خود را به صورت متن ارسال کنید:",
-            reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
-        )
-    else:
-        update.message.reply_text("لطفاً مراحل را از /start دنبال کنید.")
+    _remember_outcomes(results, memo_keys, graded)
+    return results
+
+async def async_process_sql(update: Update, context: CallbackContext, sql_text: str, submission: dict = None, questions: list = None):
+    """
+    معادل async تابع process_sql. برخلاف نسخه همگام، شمارنده در تراکنش کوتاه جداگانه رزرو می‌شود
+    تا صدها تصحیح هم‌زمان هر کدام یک اتصال BOOKKEEPING و قفل ردیف شمارنده را نگه ندارند؛
+    اگر تصحیح یا ثبت نتیجه شکست بخورد، ارسال دوباره از شمارنده کم می‌شود.
+    """
+    submission = submission or context.user_data
+    questions = questions if questions is not None else iter_submission([sql_text])
+    
+    try:
+        async with async_runtime.engine.begin() as conn:
+            new_submission_count = await conn.run_sync(reserve_submission_attempt, submission["student_id"], submission["hw"])
+    except Exception as e:
+        await async_runtime.run_blocking(_reply_storage_error, update, e)
+        return
+    
+    outcomes = {}
+    if new_submission_count is not None:
+        try:
+            outcomes = await async_grade_submission(submission["hw"], submission["major"], questions)
+            row = _submission_result_row(submission, sql_text, outcomes)
+            await async_runtime.run_blocking(result_writer.add, "student_results", row)
+        except Exception as e:
+            try:
+                async with async_runtime.engine.begin() as conn:
+                    await conn.run_sync(release_submission_attempt, submission["student_id"], submission["hw"])
+            except Exception as release_error:
+                print(f"Error releasing submission attempt of {submission['student_id']}: {release_error}")
+            await async_runtime.run_blocking(_reply_storage_error, update, e)
+            return
+    
+    await async_runtime.run_blocking(send_grading_result, update, submission, outcomes, new_submission_count)
 
-def process_sql(update: Update, context: CallbackContext, sql_text: str):
+async def _run_queued_grading(update: Update, context: CallbackContext, sql_text: str, submission: dict, questions: list):
+    async with async_runtime.grading_slots:
+        async_runtime.waiting_gradings -= 1
+        try:
+            await async_process_sql(update, context, sql_text, submission, questions)
+        except Exception as e:
+            print(f"Error grading submission of {submission['student_id']}: {e}")
+            await async_runtime.run_blocking(reply_grading_failed, update)
+
+async def async_enqueue_submission(update: Update, context: CallbackContext, sql_text: str, questions: list = None):
+    """معادل async تابع enqueue_submission؛ به جای صف و thread کارگر هر ارسال یک task روی حلقه است"""
     chat_id = update.message.chat_id
+    questions = questions if questions is not None else split_submission(sql_text)
+    duplicates = duplicate_question_numbers(questions)
+    if duplicates:
+        await async_runtime.run_blocking(reply_duplicate_questions, update, duplicates)
+        return
     
-    queries = re.split(r"--\s*#\d+", sql_text, flags=re.IGNORECASE)
-    queries = [q.strip() for q in queries if q.strip()]
+    submission = {key: context.user_data[key] for key in ("hw", "name", "student_id", "major")}
     
-    hw = context.user_data["hw"]
-    name = context.user_data["name"]
-    student_id = context.user_data["student_id"]
-    major = context.user_data["major"]
+    if async_runtime.waiting_gradings >= GRADING_QUEUE_SIZE:
+        await async_runtime.run_blocking(reply_grading_queue_full, update)
+        return
     
-    submission_count = get_submission_count(student_id, hw)
-    if submission_count >= 10:
-        update.message.reply_text(
-            f"❌ شما قبلاً ۱۰ بار تمرین {hw} را ارسال کرده‌اید و حق ارسال مجدد ندارید.",
-            reply_markup=get_main_menu()
-        )
-        user_state[chat_id] = "completed"
+    await call_user_state(user_state.__setitem__, chat_id, "grading")
+    async_runtime.waiting_gradings += 1
+    await async_runtime.run_blocking(reply_submission_queued, update, async_runtime.waiting_gradings)
+    async_runtime.spawn(_run_queued_grading(update, context, sql_text, submission, questions))
+
+async def async_process_classroom_sql(update: Update, context: CallbackContext, sql_text: str):
+    context.user_data["last_query"] = sql_text
+    
+    # ممکن است لیست جدول‌های مجاز منقضی شده باشد و با اتصال همگام دوباره خوانده شود
+    if not await async_runtime.run_blocking(is_query_allowed, sql_text):
+        await async_runtime.run_blocking(reply_query_not_allowed, update)
         return
     
-    correct_count = 0
-    incorrect_questions = []
+    try:
+        async with async_runtime.classroom_engine.begin() as conn:
+            columns, rows = await conn.run_sync(fetch_classroom_rows, sql_text)
+    except Exception as e:
+        await async_runtime.run_blocking(reply_classroom_error, update, e)
+        return
     
-    with engine.begin() as conn:
-        for i, student_query in enumerate(queries):
-            question_number = i + 1
+    await async_runtime.run_blocking(reply_classroom_result, update, context, columns, rows)
+
+async def async_start(update: Update, context: CallbackContext):
+    await async_runtime.run_blocking(start, update, context)
+
+async def async_handle_message(update: Update, context: CallbackContext):
+    """
+    ارسال تمرین و کوئری‌های سرکلاسی روی حلقه asyncio اجرا می‌شوند؛ بقیه مراحل منو
+    کم‌تکرارند و همان هندلر همگام در thread pool اجرا می‌شود.
+    """
+    chat_id = update.message.chat_id
+    message_text = update.message.text
+    state = await call_user_state(user_state.get, chat_id)
+    
+    handler = ASYNC_STATE_HANDLERS.get(state) if message_text not in SHARED_TRANSITIONS else None
+    if handler is None:
+        await async_runtime.run_blocking(handle_message, update, context)
+        return
+    
+    started = time.perf_counter()
+    try:
+        await handler(update, context, message_text)
+    finally:
+        next_state = await call_user_state(user_state.get, chat_id)
+        state_metrics.observe(state, next_state, time.perf_counter() - started)
+
+# وضعیت‌هایی که در حالت asyncio به جای STATE_HANDLERS روی حلقه رویداد پردازش می‌شوند
+ASYNC_STATE_HANDLERS = {
+    "waiting_sql": async_enqueue_submission,
+    "waiting_classroom_sql": async_process_classroom_sql,
+}
+
+async def async_handle_document(update: Update, context: CallbackContext):
+    chat_id = update.message.chat_id
+    document: Document = update.message.document
+    
+    state = await call_user_state(user_state.get, chat_id)
+    if state == "waiting_sql" and document.file_name.endswith(".sql"):
+        try:
+            sql_text, questions = await async_runtime.run_blocking(read_sql_document, document)
+        except SubmissionTooLarge:
+            await async_runtime.run_blocking(reply_document_too_large, update)
+            return
+        except Exception as e:
+            await async_runtime.run_blocking(reply_document_download_failed, update, e)
+            return
+        await async_enqueue_submission(update, context, sql_text, questions)
+    else:
+        await async_runtime.run_blocking(handle_document, update, context)
+
+# ==================== دیسپچ هم‌زمان با حفظ ترتیب هر چت ====================
+
+# تعداد threadهای پردازش پیام‌ها؛ ۱ یعنی مثل قبل همه پیام‌ها به ترتیب روی thread دیسپچر پردازش شوند
+DISPATCH_WORKERS = int(os.environ.get("DISPATCH_WORKERS", "1"))
+# پیام‌های بیش از این تعداد در انتظار یک چت کنار گذاشته می‌شوند
+DISPATCH_MAX_PENDING_PER_CHAT = int(os.environ.get("DISPATCH_MAX_PENDING_PER_CHAT", "20"))
+
+class ChatSerialDispatcher:
+    """
+    پیام‌های چت‌های مختلف را هم‌زمان روی یک thread pool و پیام‌های هر چت را به ترتیب
+    از صف همان چت پردازش می‌کند. در هر لحظه حداکثر یک thread روی هر چت کار می‌کند،
+    پس user_state و context.user_data یک چت هیچ‌وقت هم‌زمان تغییر نمی‌کنند.
+    """
+
+    def __init__(self, workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        # وجود صف یک چت یعنی یک thread در حال پردازش پیام‌های آن است
+        self._queues = {}
+        self._lock = Lock()
+
+    def dispatch(self, handler):
+        def callback(update: Update, context: CallbackContext):
+            self.submit(update.effective_chat.id, handler, update, context)
+        return callback
+
+    def submit(self, chat_id, handler, update: Update, context: CallbackContext):
+        with self._lock:
+            chat_queue = self._queues.get(chat_id)
+            if chat_queue is not None and len(chat_queue) >= DISPATCH_MAX_PENDING_PER_CHAT:
+                print(f"Dropping update for chat {chat_id}: {len(chat_queue)} updates already pending")
+                return
+            start_draining = chat_queue is None
+            if start_draining:
+                chat_queue = self._queues[chat_id] = deque()
+            chat_queue.append((handler, update, context))
+        if start_draining:
+            self.executor.submit(self._drain, chat_id)
+
+    def _drain(self, chat_id):
+        while True:
+            with self._lock:
+                chat_queue = self._queues[chat_id]
+                if not chat_queue:
+                    del self._queues[chat_id]
+                    return
+                handler, update, context = chat_queue.popleft()
             try:
-                student_rows = conn.execute(text(student_query)).fetchall()
-                if major == "آمار":
-                    reference_table = f"hw{hw}_q{question_number}_stat_reference"
-                else:
-                    reference_table = f"hw{hw}_q{question_number}_cs_reference"
-                
-                reference_rows = conn.execute(text(f"SELECT * FROM {reference_table}")).fetchall()
-                
-                if set(student_rows) == set(reference_rows):
-                    correct_count += 1
-                else:
-                    incorrect_questions.append(question_number)
-                    
+                handler(update, context)
             except Exception as e:
-                print(f"Error executing query {question_number}: {e}")
-                incorrect_questions.append(question_number)
-        
+                print(f"Error in handler {handler.__name__} for chat {chat_id}: {e}")
+
+chat_dispatcher = ChatSerialDispatcher(DISPATCH_WORKERS)
+
+# ==================== مهاجرت‌های schema ====================
+
+# هر مهاجرت فقط یک بار اجرا و نسخه آن در جدول schema_migrations ثبت می‌شود.
+# مهاجرت‌های قبلی را هرگز تغییر ندهید؛ برای تغییر جدید یک نسخه جدید اضافه کنید.
+SCHEMA_MIGRATIONS = [
+    (1, "create student_results", [
+        """
+        CREATE TABLE IF NOT EXISTS student_results (
+            id SERIAL PRIMARY KEY,
+            student_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            major TEXT NOT NULL,
+            hw TEXT NOT NULL,
+            correct_count INTEGER NOT NULL,
+            sql_queries TEXT NOT NULL,
+            submission_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (2, "add student_results.question_outcomes", [
+        "ALTER TABLE student_results ADD COLUMN IF NOT EXISTS question_outcomes TEXT",
+    ]),
+    (3, "create teacher_queries", [
+        """
+        CREATE TABLE IF NOT EXISTS teacher_queries (
+            id SERIAL PRIMARY KEY,
+            student_id TEXT NOT NULL,
+            student_name TEXT NOT NULL,
+            major TEXT NOT NULL,
+            query TEXT NOT NULL,
+            output TEXT,
+            submission_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (4, "add stuid.email_history", [
+        "ALTER TABLE stuid ADD COLUMN IF NOT EXISTS email_history TEXT",
+    ]),
+    (5, "create reference_fingerprints", [
+        """
+        CREATE TABLE IF NOT EXISTS reference_fingerprints (
+            hw TEXT NOT NULL,
+            question INTEGER NOT NULL,
+            track TEXT NOT NULL,
+            row_count BIGINT NOT NULL,
+            digest NUMERIC NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (hw, question, track)
+        )
+        """,
+    ]),
+    (6, "notify on allowed_tables changes", [
+        "CREATE TABLE IF NOT EXISTS allowed_tables (table_name TEXT PRIMARY KEY)",
+        """
+        CREATE OR REPLACE FUNCTION notify_allowed_tables_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('allowed_tables_changed', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS allowed_tables_changed ON allowed_tables",
+        """
+        CREATE TRIGGER allowed_tables_changed
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON allowed_tables
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_allowed_tables_changed()
+        """,
+    ]),
+    (7, "create submission_counters and student_results indexes", [
+        """
+        CREATE TABLE IF NOT EXISTS submission_counters (
+            student_id TEXT NOT NULL,
+            hw TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (student_id, hw)
+        )
+        """,
+        """
+        INSERT INTO submission_counters (student_id, hw, attempts)
+        SELECT student_id, hw, COUNT(*) FROM student_results GROUP BY student_id, hw
+        ON CONFLICT (student_id, hw) DO NOTHING
+        """,
+        "CREATE INDEX IF NOT EXISTS student_results_student_hw_idx ON student_results (student_id, hw)",
+        "CREATE INDEX IF NOT EXISTS student_results_hw_idx ON student_results (hw)",
+    ]),
+    (8, "add submission_uid for write-behind inserts", [
+        "ALTER TABLE student_results ADD COLUMN IF NOT EXISTS submission_uid TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS student_results_submission_uid_idx ON student_results (submission_uid)",
+        "ALTER TABLE teacher_queries ADD COLUMN IF NOT EXISTS submission_uid TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS teacher_queries_submission_uid_idx ON teacher_queries (submission_uid)",
+    ]),
+    (9, "create conversation_state", [
+        """
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            chat_id TEXT PRIMARY KEY,
+            state TEXT,
+            user_data TEXT NOT NULL DEFAULT '{}',
+            state_changed_at DOUBLE PRECISION NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+]
+
+# کلید قفل advisory تا چند نسخه هم‌زمان ربات مهاجرت‌ها را دوباره اجرا نکنند
+_MIGRATIONS_LOCK_ID = 1404_1405
+
+def run_migrations() -> int:
+    """مهاجرت‌های اجرانشده را به ترتیب نسخه در یک تراکنش اجرا می‌کند و تعداد آن‌ها را برمی‌گرداند"""
+    applied_count = 0
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": _MIGRATIONS_LOCK_ID})
         conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS student_results (
-                id SERIAL PRIMARY KEY,
-                student_id TEXT NOT NULL,
-                name TEXT NOT NULL,
-                major TEXT NOT NULL,
-                hw TEXT NOT NULL,
-                correct_count INTEGER NOT NULL,
-                sql_queries TEXT NOT NULL,
-                submission_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """))
-        
-        try:
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations")).fetchall()}
+        for version, description, statements in SCHEMA_MIGRATIONS:
+            if version in applied:
+                continue
+            for statement in statements:
+                conn.execute(text(statement))
             conn.execute(
-                text("INSERT INTO student_results (student_id, name, major, hw, correct_count, sql_queries) VALUES (:student_id, :name, :major, :hw, :correct_count, :sql_queries)"),
-                {"student_id": student_id, "name": name, "major": major, "hw": hw, "correct_count": correct_count, "sql_queries": sql_text}
+                text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+                {"version": version, "description": description}
             )
-            print(f"✅ Data inserted successfully for {name} ({student_id}) - Major: {major} - HW{hw}: {correct_count} correct")
+            applied_count += 1
+            print(f"✅ Applied migration {version}: {description}")
+    return applied_count
+
+# ==================== اعلان‌های دیتابیس (LISTEN/NOTIFY) ====================
+
+ALLOWED_TABLES_CHANNEL = "allowed_tables_changed"
+REFERENCE_TABLES_CHANNEL = "reference_tables_changed"
+
+def _on_allowed_tables_changed(payload: str):
+    allowed_tables_registry.refresh()
+
+def _on_reference_tables_changed(payload: str):
+    # payload شماره تمرین است؛ payload خالی یعنی همه تمرین‌ها
+    invalidate_reference_cache(payload or None)
+
+notification_handlers = {
+    ALLOWED_TABLES_CHANNEL: _on_allowed_tables_changed,
+    REFERENCE_TABLES_CHANNEL: _on_reference_tables_changed,
+    CONVERSATION_STATE_CHANNEL: _on_conversation_state_changed,
+}
+
+def _listen_for_notifications():
+    """روی یک اتصال اختصاصی (خارج از pool) به کانال‌های اعلان گوش می‌دهد و در صورت قطعی دوباره وصل می‌شود"""
+    # اعلان‌ها روی replica تحویل داده نمی‌شوند؛ LISTEN همیشه روی دیتابیس اصلی است
+    listen_engine = create_engine(DB_URI, poolclass=NullPool)
+    while True:
+        raw_connection = None
+        try:
+            raw_connection = listen_engine.raw_connection()
+            dbapi_connection = raw_connection.driver_connection
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            for channel in notification_handlers:
+                cursor.execute(f"LISTEN {channel}")
+            # اعلان‌هایی که در زمان قطعی از دست رفته‌اند جبران می‌شوند
+            for handler in notification_handlers.values():
+                handler("")
+            while True:
+                if select.select([dbapi_connection], [], [], 60) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    try:
+                        notification_handlers[notify.channel](notify.payload)
+                    except Exception as e:
+                        print(f"Error handling notification on {notify.channel}: {e}")
         except Exception as e:
-            print(f"❌ Error inserting data: {e}")
-            update.message.reply_text(f"⚠️ خطا در ذخیره‌سازی: {str(e)}")
-            return
-    
-    persian_date, persian_time = get_persian_datetime()
-    
-    result_message = f"🎉 تصحیح با موفقیت انجام شد!\n\n"
-    result_message += f"┌─────────────────────────────\n"
-    result_message += f"│ 📅 تاریخ: {persian_date}\n"
-    result_message += f"│ 🕐 ساعت: {persian_time}\n"
-    result_message += f"├─────────────────────────────\n"
-    result_message += f"│ 👤 دانشجو: {name}\n"
-    result_message += f"│ 🆔 شماره دانشجویی: {student_id}\n"
-    result_message += f"│ 📚 رشته: {major}\n"
-    result_message += f"│ 📝 تمرین: {hw}\n"
-    result_message += f"└─────────────────────────────\n\n"
-    result_message += f"📊 نتیجه: {correct_count}/{len(queries)} سوال درست است.\n\n"
-    
-    if major == "آمار":
-        email_address = "hw@statdb.ir"
-    else:
-        email_address = "hw@dbcs.ir"
-    
-    result_message += f"📧 لطفاً از این پیام اسکرین شات بگیرید و با عنوانی که پیش‌تر توضیح داده شده و تمرین‌های قبلی را ارسال می‌کردید به آدرس:\n"
-    result_message += f"✉️ {email_address}\n\n"
+            print(f"Notification listener error, reconnecting: {e}")
+            time.sleep(5)
+        finally:
+            if raw_connection is not None:
+                try:
+                    raw_connection.close()
+                except Exception:
+                    pass
+
+def start_notification_listener():
+    """شنونده اعلان‌ها را فقط برای Postgres راه‌اندازی می‌کند؛ در غیر این صورت TTL کافی است"""
+    if engine.dialect.name != "postgresql":
+        return
+    Thread(target=_listen_for_notifications, name="db-notifications", daemon=True).start()
+
+# ==================== تصحیح مجدد ارسال‌های ذخیره‌شده ====================
+
+REGRADE_WORKER_POOL_SIZE = int(os.environ.get("REGRADE_WORKER_POOL_SIZE", "2"))
+
+def _regrade_worker_init():
+    """هر پردازه کارگر pool اتصال مخصوص به خود را می‌سازد و از اتصال‌های پردازه اصلی استفاده نمی‌کند"""
+    global grading_engine
+    # اتصال‌های engine اصلی متعلق به پردازه والد هستند؛ فقط کنار گذاشته می‌شوند و بسته نمی‌شوند
+    engine.dispose(close=False)
+    grading_engine = create_engine(CLASSROOM_DB_URI, pool_pre_ping=True, pool_size=REGRADE_WORKER_POOL_SIZE, max_overflow=0)
+
+def _regrade_batch(rows: list) -> list:
+    """یک دسته از ارسال‌ها را تصحیح می‌کند و (id, تعداد درست قبلی, تعداد درست جدید, نتیجه سوال‌ها) برمی‌گرداند"""
+    regraded = []
+    for submission_id, hw, major, sql_queries, old_correct_count in rows:
+        outcomes = grade_submission(hw, major, split_submission(sql_queries))
+        correct_count = sum(1 for outcome in outcomes.values() if outcome == OUTCOME_CORRECT)
+        regraded.append((submission_id, old_correct_count, correct_count, json.dumps(outcomes)))
+    return regraded
+
+def _write_regrade_results(updates: list):
+    with engine.begin() as conn:
+        conn.execute(
+            text("UPDATE student_results SET correct_count = :correct_count, question_outcomes = :question_outcomes WHERE id = :id"),
+            updates
+        )
+
+def regrade_submissions(hw: str = None, student_id: str = None, major: str = None,
+                        workers: int = None, batch_size: int = 100):
+    """ارسال‌های ذخیره‌شده در student_results را با جواب‌های مرجع فعلی دوباره تصحیح می‌کند"""
+    conditions = []
+    params = {}
+    for column, value in (("hw", hw), ("student_id", student_id), ("major", major)):
+        if value is not None:
+            conditions.append(f"{column} = :{column}")
+            params[column] = value
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
     
-    if incorrect_questions:
-        result_message += "❌ سوال‌های نادرست: " + ", ".join(map(str, incorrect_questions)) + "\n\n"
+    # جواب‌های مرجع ممکن است اصلاح شده باشند؛ اثرانگشت‌های ذخیره‌شده و کش‌ها دوباره ساخته می‌شوند
+    if GRADING_MODE == "server":
+        refresh_reference_fingerprints(hw)
     else:
-        result_message += "🏆 تبریک! تمام سوال‌ها صحیح است!\n\n"
-    
-    new_submission_count = submission_count + 1
-    remaining_attempts = 10 - new_submission_count
-    result_message += f"📈 ارسال‌های انجام شده: {new_submission_count}/10\n"
-    result_message += f"📊 ارسال‌های باقی‌مانده: {remaining_attempts}\n\n"
+        invalidate_reference_cache(hw)
     
-    if remaining_attempts == 0:
-        result_message += "⚠️ این آخرین ارسال شما برای این تمرین بود.\n\n"
-    
-    result_message += "🤔 آیا می‌خواهید تمرین جدیدی ثبت کنید؟"
-    
-    update.message.reply_text(result_message, reply_markup=get_main_menu())
-    user_state[chat_id] = "completed"
-
-def process_classroom_sql(update: Update, context: CallbackContext, sql_text: str):
-    chat_id = update.message.chat_id
-    name = context.user_data["name"]
-    student_id = context.user_data["student_id"]
-    major = context.user_data["major"]
+    workers = workers or os.cpu_count()
+    started_at = time.monotonic()
+    regraded_count = 0
+    changed_count = 0
+    updates = []
     
-    # ذخیره کوئری در context برای استفاده بعدی
-    context.user_data["last_query"] = sql_text
+    def collect(future):
+        nonlocal regraded_count, changed_count, updates
+        for submission_id, old_correct_count, correct_count, outcomes in future.result():
+            updates.append({"id": submission_id, "correct_count": correct_count, "question_outcomes": outcomes})
+            regraded_count += 1
+            if correct_count != old_correct_count:
+                changed_count += 1
+        if len(updates) >= batch_size:
+            _write_regrade_results(updates)
+            updates = []
+        elapsed = time.monotonic() - started_at
+        print(f"Regraded {regraded_count}/{total} submissions ({regraded_count / elapsed:.1f}/s)")
     
-    if not is_query_allowed(sql_text):
-        # دریافت لیست جدول‌های مجاز برای نمایش به کاربر
-        allowed_tables = get_allowed_tables()
-        tables_list = "\n".join([f"• {table}" for table in allowed_tables])
-        
-        update.message.reply_text(
-            f"❌ کوئری شما مجاز نیست!\n\n"
-            f"✅ جدول‌های مجاز:\n{tables_list}\n\n"
-            "⚠️ محدودیت‌ها:\n"
-            "• فقط دستورات SELECT مجاز هستند\n"
-            "• فقط می‌توانید از جدول‌های بالا استفاده کنید\n"
-            "• دستورات INSERT, UPDATE, DELETE, DROP, CREATE, ALTER ممنوع هستند\n"
-            "• سایر جدول‌ها غیرقابل دسترسی هستند\n\n"
-            "💻 لطفاً یک کوئری SELECT معتبر ارسال کنید:",
-            reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
+    with engine.connect() as conn:
+        total = conn.execute(text(f"SELECT COUNT(*) FROM student_results {where_clause}"), params).scalar()
+        print(f"Regrading {total} submissions with {workers} workers...")
+        result = conn.execute(
+            text(f"SELECT id, hw, major, sql_queries, correct_count FROM student_results {where_clause} ORDER BY id"),
+            params,
+            execution_options={"yield_per": batch_size}
         )
-        return
+        with ProcessPoolExecutor(max_workers=workers, initializer=_regrade_worker_init) as executor:
+            # فقط چند دسته در صف پردازه‌ها می‌ماند تا کل جدول در حافظه بارگذاری نشود
+            in_flight = set()
+            for batch in result.partitions():
+                if len(in_flight) >= workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future)
+                in_flight.add(executor.submit(_regrade_batch, [tuple(row) for row in batch]))
+            for future in as_completed(in_flight):
+                collect(future)
     
+    if updates:
+        _write_regrade_results(updates)
+    elapsed = time.monotonic() - started_at
+    print(f"✅ Regrade finished: {regraded_count} submissions in {elapsed:.1f}s "
+          f"({regraded_count / elapsed if elapsed else 0:.1f}/s), {changed_count} scores changed")
+    return regraded_count, changed_count
+
+# ==================== صف ارسال پیام‌ها ====================
+
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))  # پیام در ثانیه برای کل ربات
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))  # پیام در ثانیه برای هر چت خصوصی
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE_PER_MINUTE", "20")) / 60  # برای هر گروه
+OUTBOUND_CHAT_BURST = int(os.environ.get("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_SENDERS = int(os.environ.get("OUTBOUND_SENDERS", "4"))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+
+# عدد کمتر یعنی اولویت بیشتر
+OUTBOUND_LANE_GRADING_RESULT = 0
+OUTBOUND_LANE_REPLY = 1
+OUTBOUND_LANE_ADMIN = 2
+
+_outbound_context = local()
+
+@contextmanager
+def outbound_lane(lane: int):
+    """پیام‌هایی که داخل این بلوک در همین thread فرستاده می‌شوند با اولویت lane در صف قرار می‌گیرند"""
+    previous_lane = getattr(_outbound_context, "lane", OUTBOUND_LANE_REPLY)
+    _outbound_context.lane = lane
     try:
-        with engine.begin() as conn:
-            result = conn.execute(text(sql_text))
-            rows = result.fetchall()
-            
-            # ذخیره خروجی برای ارسال احتمالی به مدرس
-            output_data = {
-                "columns": list(result.keys()),
-                "rows": [list(row) for row in rows[:100]],  # محدودیت برای جلوگیری از حجم زیاد
-                "total_rows": len(rows)
-            }
-            context.user_data["last_output"] = json.dumps(output_data, default=str)
-            
-            if rows:
-                columns = result.keys()
-                
-                result_message = "✅ نتایج اجرای کوئری:\n\n"
-                result_message += "┌" + "─" * 50 + "┐\n"
-                
-                header = "│ " + " | ".join(str(col)[:15].ljust(15) for col in columns) + " │"
-                result_message += header + "\n"
-                result_message += "├" + "─" * 50 + "┤\n"
-                
-                for i, row in enumerate(rows[:10]):
-                    row_str = "│ " + " | ".join(str(val)[:15].ljust(15) for val in row) + " │"
-                    result_message += row_str + "\n"
-                
-                result_message += "└" + "─" * 50 + "┘\n\n"
-                
-                if len(rows) > 10:
-                    result_message += f"📊 نمایش 10 ردیف اول از {len(rows)} ردیف\n\n"
-                
-            else:
-                result_message = "✅ کوئری با موفقیت اجرا شد اما هیچ نتیجه‌ای بازنگشت.\n\n"
-            
-            # اضافه کردن گزینه ارسال به مدرس
-            result_message += "📤 آیا می‌خواهید این کوئری را برای بررسی به مدرس ارسال کنید?"
+        yield
+    finally:
+        _outbound_context.lane = previous_lane
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """چند ثانیه تا آزاد شدن یک توکن مانده است (صفر یعنی همین حالا)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self.delay(now)
+        return self.tokens >= self.capacity
+
+class OutboundScheduler:
+    """
+    صف ارسال پیام‌های ربات با سقف سراسری و سقف هر چت (token bucket). پیام‌های هر چت به
+    ترتیب و یکی‌یکی ارسال می‌شوند و بین چت‌ها، چتی که پیام جلوی صفش اولویت بیشتری دارد
+    زودتر ارسال می‌شود. در صورت RetryAfter همان پیام پس از زمان اعلام‌شده دوباره ارسال می‌شود.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._chats = {}  # پیام‌های در انتظار هر چت
+        self._in_flight = set()
+        self._ready = []  # heap از (lane, ترتیب, chat_id)
+        self._delayed = []  # heap از (زمان آزاد شدن, lane, ترتیب, chat_id)
+        self._chat_buckets = {}
+        # ظرفیت ۱ یعنی ارسال‌ها یکنواخت پخش می‌شوند و در هیچ ثانیه‌ای از سقف سراسری بیشتر نمی‌شوند
+        self._global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, 1)
+        self._sequence = itertools.count()
+        self._executor = None
+        self._thread = None
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and not self._stopping
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=OUTBOUND_SENDERS, thread_name_prefix="outbound")
+        self._thread = Thread(target=self._run, name="outbound-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """ارسال پیام‌های باقی‌مانده را تمام و صف را متوقف می‌کند"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, chat_id, send, lane: int) -> Future:
+        chat_key = str(chat_id)
+        message = {"send": send, "lane": lane, "future": Future(), "attempts": 0}
+        with self._condition:
+            chat_queue = self._chats.setdefault(chat_key, deque())
+            chat_queue.append(message)
+            # چتی که پیام در انتظار یا در حال ارسال دارد قبلاً زمان‌بندی شده است
+            if len(chat_queue) == 1 and chat_key not in self._in_flight:
+                heapq.heappush(self._ready, (lane, next(self._sequence), chat_key))
+                self._condition.notify_all()
+        return message["future"]
+
+    def _chat_bucket(self, chat_key: str) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_key)
+        if bucket is None:
+            rate = OUTBOUND_GROUP_RATE if chat_key.startswith("-") else OUTBOUND_CHAT_RATE
+            bucket = self._chat_buckets[chat_key] = TokenBucket(rate, OUTBOUND_CHAT_BURST)
+        return bucket
+
+    def _next_message(self):
+        """پیام بعدی قابل ارسال را با رعایت اولویت و سقف‌ها برمی‌دارد (باید با قفل فراخوانی شود)"""
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, lane, sequence, chat_key = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (lane, sequence, chat_key))
             
-            # ایجاد کیبورد با گزینه‌های جدید
-            keyboard = [
-                ["✅ بله، ارسال به مدرس"],
-                ["❌ خیر، فقط نمایش"],
-                ["🔙 بازگشت به منو اصلی"]
-            ]
+            if not self._ready:
+                if self._stopping and not self._chats:
+                    return None, None
+                self._condition.wait(self._delayed[0][0] - now if self._delayed else None)
+                continue
             
-            update.message.reply_text(
-                result_message,
-                reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-            )
+            global_delay = self._global_bucket.delay(now)
+            if global_delay > 0:
+                self._condition.wait(global_delay)
+                continue
             
-            # تغییر state برای مدیریت پاسخ کاربر
-            user_state[chat_id] = "waiting_teacher_submission_decision"
+            lane, sequence, chat_key = heapq.heappop(self._ready)
+            bucket = self._chat_bucket(chat_key)
+            chat_delay = bucket.delay(now)
+            if chat_delay > 0:
+                heapq.heappush(self._delayed, (now + chat_delay, lane, sequence, chat_key))
+                continue
             
-    except Exception as e:
-        error_message = f"❌ خطا در اجرای کوئری:\n\n{str(e)}\n\n"
-        error_message += "💻 لطفاً کوئری خود را بررسی و مجدداً ارسال کنید:"
+            self._global_bucket.take()
+            bucket.take()
+            self._in_flight.add(chat_key)
+            return chat_key, self._chats[chat_key].popleft()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                chat_key, message = self._next_message()
+            if message is None:
+                self._executor.shutdown(wait=True)
+                return
+            self._executor.submit(self._send, chat_key, message)
+
+    def _send(self, chat_key: str, message: dict):
+        retry_at = None
+        message["attempts"] += 1
+        try:
+            message["future"].set_result(message["send"]())
+        except RetryAfter as e:
+            if message["attempts"] > OUTBOUND_MAX_RETRIES:
+                print(f"Giving up on message to chat {chat_key} after {message['attempts']} attempts: {e}")
+                message["future"].set_exception(e)
+            else:
+                print(f"Flood control for chat {chat_key}, retrying in {e.retry_after}s")
+                retry_at = time.monotonic() + e.retry_after
+        except Exception as e:
+            print(f"Error sending message to chat {chat_key}: {e}")
+            message["future"].set_exception(e)
         
-        update.message.reply_text(
-            error_message,
-            reply_markup=ReplyKeyboardMarkup([["🔙 بازگشت به منو اصلی"]], one_time_keyboard=True, resize_keyboard=True)
-        )
-        user_state[chat_id] = "waiting_classroom_sql"
+        with self._condition:
+            self._in_flight.discard(chat_key)
+            chat_queue = self._chats[chat_key]
+            if retry_at is not None:
+                chat_queue.appendleft(message)
+                heapq.heappush(self._delayed, (retry_at, message["lane"], next(self._sequence), chat_key))
+            elif chat_queue:
+                heapq.heappush(self._ready, (chat_queue[0]["lane"], next(self._sequence), chat_key))
+            else:
+                del self._chats[chat_key]
+                # سقفی که کاملاً پر شده اثری ندارد و نگه داشتنش فقط حافظه مصرف می‌کند
+                if self._chat_buckets[chat_key].is_full(time.monotonic()):
+                    del self._chat_buckets[chat_key]
+            self._condition.notify_all()
 
-# ==================== راه‌اندازی ربات ====================
+outbound_scheduler = OutboundScheduler()
+
+class ScheduledBot(ExtBot):
+    """
+    ExtBot که send_message (و در نتیجه reply_text) را از صف ارسال عبور می‌دهد. تا زمانی که صف
+    راه‌اندازی نشده پیام مستقیم ارسال می‌شود؛ پس از آن به جای Message یک Future برگردانده می‌شود.
+    """
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        send = partial(super().send_message, chat_id, text, *args, **kwargs)
+        if not outbound_scheduler.running:
+            return send()
+        if str(chat_id) == str(ADMIN_CHAT_ID):
+            lane = OUTBOUND_LANE_ADMIN
+        else:
+            lane = getattr(_outbound_context, "lane", OUTBOUND_LANE_REPLY)
+        return outbound_scheduler.submit(chat_id, send, lane)
+
+# ==================== خلاصه اطلاع‌رسانی‌های ادمین ====================
+
+# رویدادهای ادمین در این بازه (ثانیه) جمع و به صورت یک پیام خلاصه ارسال می‌شوند؛ 0 یعنی ارسال تک‌تک مثل قبل
+ADMIN_DIGEST_WINDOW = float(os.environ.get("ADMIN_DIGEST_WINDOW", "60"))
+# نوع رویدادهایی که بدون انتظار برای خلاصه ارسال می‌شوند (جداشده با کاما)
+ADMIN_DIGEST_URGENT_TYPES = {event_type.strip() for event_type in os.environ.get("ADMIN_DIGEST_URGENT_TYPES", "").split(",") if event_type.strip()}
+ADMIN_DIGEST_TOP_STUDENTS = int(os.environ.get("ADMIN_DIGEST_TOP_STUDENTS", "5"))
+ADMIN_DIGEST_MAX_DETAILS = int(os.environ.get("ADMIN_DIGEST_MAX_DETAILS", "5"))
+ADMIN_DIGEST_DETAIL_CHARS = int(os.environ.get("ADMIN_DIGEST_DETAIL_CHARS", "120"))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+ADMIN_EVENT_LABELS = {
+    "teacher_query": "📤 کوئری جدید برای بررسی",
+    "email_change": "🔔 ثبت/ویرایش ایمیل",
+}
+
+def _truncate_detail(detail: str) -> str:
+    detail = " ".join(detail.split())
+    if len(detail) > ADMIN_DIGEST_DETAIL_CHARS:
+        return detail[:ADMIN_DIGEST_DETAIL_CHARS] + "…"
+    return detail
+
+def format_admin_digest(events: list, window: float) -> str:
+    persian_date, persian_time = get_persian_datetime()
+    lines = [
+        "📬 خلاصه اطلاع‌رسانی‌ها\n",
+        f"📅 تاریخ: {persian_date}",
+        f"🕐 ساعت: {persian_time}",
+        f"🔢 {len(events)} رویداد در {int(window)} ثانیه اخیر\n",
+    ]
+    
+    type_counts = Counter(event["type"] for event in events)
+    for event_type, count in type_counts.most_common():
+        lines.append(f"{ADMIN_EVENT_LABELS.get(event_type, event_type)}: {count}")
+    
+    student_counts = Counter((event["student_id"], event["name"]) for event in events)
+    lines.append("\n👥 بیشترین فعالیت:")
+    for (student_id, name), count in student_counts.most_common(ADMIN_DIGEST_TOP_STUDENTS):
+        lines.append(f"• {name} ({student_id}): {count}")
+    
+    for event_type, count in type_counts.most_common():
+        details = [event for event in events if event["type"] == event_type and event["detail"]]
+        if not details:
+            continue
+        lines.append(f"\n{ADMIN_EVENT_LABELS.get(event_type, event_type)} - آخرین موارد:")
+        for event in details[-ADMIN_DIGEST_MAX_DETAILS:]:
+            lines.append(f"• {event['name']}: {_truncate_detail(event['detail'])}")
+        if len(details) > ADMIN_DIGEST_MAX_DETAILS:
+            lines.append(f"(و {len(details) - ADMIN_DIGEST_MAX_DETAILS} مورد دیگر)")
+    
+    digest = "\n".join(lines)
+    if len(digest) > TELEGRAM_MESSAGE_LIMIT:
+        digest = digest[:TELEGRAM_MESSAGE_LIMIT - 1] + "…"
+    return digest
 
-updater = Updater(TOKEN, use_context=True)
-dp = updater.dispatcher
-dp.add_handler(CommandHandler("start", start))
-dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
-dp.add_handler(MessageHandler(Filters.document, handle_document))
-updater.start_polling()
+class AdminDigest:
+    """
+    رویدادهای ادمین (ثبت ایمیل، ارسال کوئری برای مدرس و ...) را بیرون از مسیر درخواست دانشجو جمع
+    می‌کند و هر ADMIN_DIGEST_WINDOW ثانیه یک پیام خلاصه به ادمین می‌فرستد. اگر در یک بازه فقط
+    یک رویداد باشد همان پیام کامل آن ارسال می‌شود.
+    """
 
-# ==================== وب سرور Flask برای Keep Alive ====================
+    def __init__(self, window: float):
+        self.window = window
+        self._events = []
+        self._condition = Condition()
+        self._thread = None
+        self._stopping = False
+        self._bot = None
+
+    def add(self, context: CallbackContext, event_type: str, message: str, student_id: str, name: str,
+            detail: str = "", urgent: bool = False):
+        if urgent or event_type in ADMIN_DIGEST_URGENT_TYPES or self.window <= 0 or self._thread is None:
+            send_notification_to_admin(context, message)
+            return
+        with self._condition:
+            self._bot = context.bot
+            self._events.append({
+                "type": event_type,
+                "message": message,
+                "student_id": student_id,
+                "name": name,
+                "detail": detail,
+            })
+
+    def flush(self):
+        with self._condition:
+            events, self._events = self._events, []
+            bot = self._bot
+        if not events:
+            return
+        message = events[0]["message"] if len(events) == 1 else format_admin_digest(events, self.window)
+        try:
+            bot.send_message(chat_id=ADMIN_CHAT_ID, text=message)
+        except Exception as e:
+            print(f"Error sending admin digest of {len(events)} events: {e}")
+
+    def start(self):
+        if self.window <= 0 or self._thread is not None:
+            return
+        self._thread = Thread(target=self._run, name="admin-digest", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopping, timeout=self.window)
+                stopping = self._stopping
+            self.flush()
+            if stopping:
+                return
+
+admin_digest = AdminDigest(ADMIN_DIGEST_WINDOW)
+
+# ==================== راه‌اندازی ربات ====================
 
 app = Flask('')
+
 @app.route('/')
 def home():
     return "ربات تلگرام فعال است ✅"
@@ -842,5 +3504,115 @@ def run():
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
 
-Thread(target=run).start()
-updater.idle()
+# polling: دریافت پیام‌ها با long polling؛ webhook: تلگرام پیام‌ها را به همین سرور Flask می‌فرستد
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # آدرس عمومی سرور، مثلاً https://bot.example.com
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram/webhook")
+# در صورت تنظیم نشدن در هر اجرا مقدار تصادفی ساخته می‌شود؛ با چند نسخه هم‌زمان حتماً تنظیم شود
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+# با بیشتر شدن پیام‌های پردازش‌نشده از این مقدار، پاسخ 503 داده می‌شود تا تلگرام بعداً دوباره بفرستد
+WEBHOOK_MAX_PENDING = int(os.environ.get("WEBHOOK_MAX_PENDING", "200"))
+
+webhook_dispatcher = None
+
+@app.route(WEBHOOK_PATH, methods=["POST"])
+def telegram_webhook():
+    if webhook_dispatcher is None:
+        return "", 404
+    secret_token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret_token, WEBHOOK_SECRET):
+        return "", 403
+    if webhook_dispatcher.update_queue.qsize() >= WEBHOOK_MAX_PENDING:
+        return "", 503
+    
+    update = Update.de_json(request.get_json(force=True), webhook_dispatcher.bot)
+    webhook_dispatcher.update_queue.put(update)
+    return "", 200
+
+def start_webhook(updater: Updater):
+    """دیسپچر را راه‌اندازی و آدرس webhook را به همراه secret token در تلگرام ثبت می‌کند"""
+    global webhook_dispatcher
+    Thread(target=updater.dispatcher.start, name="dispatcher", daemon=True).start()
+    # بدون running، idle با دریافت سیگنال پردازه را فوراً و بدون stop کردن دیسپچر می‌بندد
+    updater.running = True
+    webhook_dispatcher = updater.dispatcher
+    updater.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        api_kwargs={"secret_token": WEBHOOK_SECRET}
+    )
+
+def run_bot():
+    run_migrations()
+    result_writer.start()
+    user_state.start()
+    admin_digest.start()
+    allowed_tables_registry.refresh()
+    start_notification_listener()
+    
+    # بدون DISPATCH_WORKERS هندلرها مستقیماً روی thread دیسپچر اجرا می‌شوند
+    serialized = chat_dispatcher.dispatch if DISPATCH_WORKERS > 1 else (lambda handler: handler)
+    if RUNTIME_MODE == "asyncio":
+        async_runtime.start()
+        start_handler, message_handler, document_handler = (
+            async_runtime.dispatch(with_conversation_state(handler))
+            for handler in (async_start, async_handle_message, async_handle_document)
+        )
+    else:
+        start_grading_workers()
+        start_handler, message_handler, document_handler = (
+            serialized(with_conversation_state(handler)) for handler in (start, handle_message, handle_document)
+        )
+    
+    outbound_scheduler.start()
+    # همان اندازه pool پیش‌فرض Updater به اضافه یک اتصال برای هر thread ارسال
+    bot = ScheduledBot(TOKEN, request=Request(con_pool_size=8 + OUTBOUND_SENDERS))
+    updater = Updater(bot=bot, use_context=True)
+    dp = updater.dispatcher
+    dp.add_handler(CommandHandler("start", start_handler))
+    dp.add_handler(CommandHandler("reload_references", serialized(reload_references)))
+    dp.add_handler(CommandHandler("refresh_fingerprints", serialized(refresh_fingerprints)))
+    dp.add_handler(CommandHandler("pool_stats", serialized(pool_stats)))
+    dp.add_handler(CommandHandler("state_stats", serialized(state_stats)))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, message_handler))
+    dp.add_handler(MessageHandler(Filters.document, document_handler))
+    
+    # وب سرور Flask برای Keep Alive و دریافت webhook
+    Thread(target=run).start()
+    if BOT_MODE == "webhook" and WEBHOOK_URL:
+        start_webhook(updater)
+    else:
+        if BOT_MODE == "webhook":
+            print("WEBHOOK_URL is not set, falling back to polling")
+        # start_polling هر webhook ثبت‌شده قبلی را حذف می‌کند
+        updater.start_polling()
+    updater.idle()
+    result_writer.stop()
+    user_state.flush()
+    admin_digest.stop()
+    outbound_scheduler.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="ربات تصحیح تمرین‌های پایگاه داده")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("bot", help="اجرای ربات تلگرام (پیش‌فرض)")
+    subparsers.add_parser("migrate", help="اجرای مهاجرت‌های schema دیتابیس")
+    regrade_parser = subparsers.add_parser("regrade", help="تصحیح مجدد ارسال‌های ذخیره‌شده با جواب‌های مرجع فعلی")
+    regrade_parser.add_argument("--hw", help="فقط ارسال‌های این تمرین")
+    regrade_parser.add_argument("--student-id", help="فقط ارسال‌های این دانشجو")
+    regrade_parser.add_argument("--major", help="فقط ارسال‌های این رشته")
+    regrade_parser.add_argument("--workers", type=int, default=None, help="تعداد پردازه‌های کارگر")
+    regrade_parser.add_argument("--batch-size", type=int, default=100, help="اندازه دسته خواندن و نوشتن نتایج")
+    args = parser.parse_args()
+    
+    if args.command == "migrate":
+        applied_count = run_migrations()
+        print(f"{applied_count} migrations applied")
+    elif args.command == "regrade":
+        regrade_submissions(args.hw, args.student_id, args.major, args.workers, args.batch_size)
+    else:
+        run_bot()
+
+if __name__ == "__main__":
+    main()
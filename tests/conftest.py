@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# main.py در زمان import این متغیرها را لازم دارد؛ engineها تا اولین کوئری به دیتابیس وصل نمی‌شوند
+os.environ.setdefault("BOT_TOKEN", "test")
+os.environ.setdefault("ADMIN_CHAT_ID", "0")
+os.environ.setdefault("DB_URI", f"sqlite:///{os.path.join(tempfile.gettempdir(), 'telegram_bot_tests.db')}")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
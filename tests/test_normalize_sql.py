@@ -0,0 +1,35 @@
+import pytest
+
+from main import normalize_sql
+
+
+def test_collapses_whitespace_comments_and_keyword_case():
+    assert normalize_sql("SELECT  Name\n  FROM Students -- comment\nWHERE id = 1;") == \
+        normalize_sql("select name from students where id=1")
+
+
+def test_keeps_string_literal_case():
+    assert normalize_sql("SELECT 'ABC';") != normalize_sql("SELECT 'abc';")
+
+
+def test_keeps_quoted_identifier_case():
+    assert normalize_sql('SELECT "Name" FROM t') != normalize_sql('SELECT "name" FROM t')
+
+
+@pytest.mark.parametrize("first, second", [
+    ("SELECT $$ABC$$;", "SELECT $$abc$$;"),
+    ("SELECT $tag$ABC$tag$;", "SELECT $tag$abc$tag$;"),
+    ("SELECT $tag$A $$ B$tag$;", "SELECT $tag$A $$ b$tag$;"),
+    ("SELECT E'A\\'B';", "SELECT E'A\\'b';"),
+    ("SELECT e'X\\'Y -- Z';", "SELECT e'X\\'Y -- z';"),
+])
+def test_literals_that_differ_only_in_case_do_not_collide(first, second):
+    assert normalize_sql(first) != normalize_sql(second)
+
+
+def test_comment_marker_inside_escape_string_is_kept():
+    assert normalize_sql("SELECT E'it\\'s -- not a comment' FROM t") == "select E'it\\'s -- not a comment' from t"
+
+
+def test_positional_parameters_and_dollar_identifiers_are_not_strings():
+    assert normalize_sql("SELECT $1, A$B FROM T") == "select $1,a$b from t"
@@ -0,0 +1,80 @@
+import pytest
+
+import main
+from main import SubmissionTooLarge, read_sql_document
+
+PERSIAN_SUBMISSION = "-- #1\nSELECT * FROM students WHERE city = 'تهران';\n\n-- #2\nSELECT name FROM courses WHERE title = 'پایگاه داده';\n"
+
+
+# cp1256 «ی» فارسی ندارد و ویندوز به جای آن «ي» عربی ذخیره می‌کند
+CP1256_SUBMISSION = PERSIAN_SUBMISSION.replace("ی", "ي")
+
+
+class FakeFile:
+    def __init__(self, path):
+        self.file_path = path.as_uri()
+
+
+class FakeDocument:
+    def __init__(self, path, file_size=None):
+        self._path = path
+        self.file_size = file_size
+
+    def get_file(self):
+        return FakeFile(self._path)
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(main, "SQL_DOCUMENT_CHUNK_BYTES", 16)
+
+
+def read_bytes(tmp_path, data, file_size=None):
+    path = tmp_path / "submission.sql"
+    path.write_bytes(data)
+    return read_sql_document(FakeDocument(path, file_size))
+
+
+def test_utf8_file(tmp_path):
+    sql_text, questions = read_bytes(tmp_path, PERSIAN_SUBMISSION.encode("utf-8"))
+    assert sql_text == PERSIAN_SUBMISSION
+    assert [number for number, _ in questions] == [1, 2]
+    assert "'پایگاه داده'" in questions[1][1]
+
+
+def test_bom_is_stripped(tmp_path):
+    sql_text, questions = read_bytes(tmp_path, b"\xef\xbb\xbf" + PERSIAN_SUBMISSION.encode("utf-8"))
+    assert sql_text == PERSIAN_SUBMISSION
+    assert questions[0][0] == 1
+
+
+def test_cp1256_file_falls_back(tmp_path):
+    sql_text, questions = read_bytes(tmp_path, CP1256_SUBMISSION.encode("cp1256"))
+    assert sql_text == CP1256_SUBMISSION
+    assert "'تهران'" in questions[0][1]
+
+
+def test_cp1256_after_long_ascii_prefix_falls_back(tmp_path):
+    text = "-- " + "x" * 100 + "\n" + CP1256_SUBMISSION
+    sql_text, _ = read_bytes(tmp_path, text.encode("cp1256"))
+    assert sql_text == text
+
+
+def test_one_invalid_byte_in_utf8_file_is_replaced(tmp_path):
+    data = PERSIAN_SUBMISSION.encode("utf-8") + b"-- \xff\n"
+    sql_text, questions = read_bytes(tmp_path, data)
+    assert sql_text == PERSIAN_SUBMISSION + "-- �\n"
+    assert "'تهران'" in questions[0][1]
+    assert "'پایگاه داده'" in questions[1][1]
+
+
+def test_declared_size_over_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "MAX_SQL_DOCUMENT_BYTES", 32)
+    with pytest.raises(SubmissionTooLarge):
+        read_bytes(tmp_path, b"SELECT 1;", file_size=33)
+
+
+def test_downloaded_size_over_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "MAX_SQL_DOCUMENT_BYTES", 32)
+    with pytest.raises(SubmissionTooLarge):
+        read_bytes(tmp_path, b"SELECT 1;\n" * 10)
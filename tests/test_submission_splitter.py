@@ -0,0 +1,88 @@
+import pytest
+
+from main import SubmissionSplitter, duplicate_question_numbers, iter_submission, split_submission
+
+
+def split_in_chunks(text, size, marker_style=None):
+    chunks = [text[i:i + size] for i in range(0, len(text), size)]
+    return list(iter_submission(chunks, marker_style))
+
+
+def test_splits_on_dash_markers():
+    assert split_submission("-- #1\nSELECT 1;\n\n-- #2\nSELECT 2;\n") == [(1, "SELECT 1;"), (2, "SELECT 2;")]
+
+
+def test_text_before_first_marker_is_question_one():
+    assert split_submission("SELECT 1;") == [(1, "SELECT 1;")]
+
+
+def test_number_marker_style():
+    text = "# number 1\nSELECT 1;\n#Number 2\nSELECT 2;"
+    assert list(iter_submission([text], "number")) == [(1, "SELECT 1;"), (2, "SELECT 2;")]
+
+
+def test_dash_marker_is_plain_comment_in_number_style():
+    text = "# number 1\nSELECT 1; -- #2\n"
+    assert list(iter_submission([text], "number")) == [(1, "SELECT 1;")]
+
+
+def test_trailing_comments_and_whitespace_are_dropped():
+    assert split_submission("-- #1\nSELECT 1; -- done\n/* end */\n\n") == [(1, "SELECT 1;")]
+
+
+@pytest.mark.parametrize("literal", [
+    "'-- #2'",
+    "'it''s -- #2'",
+    '"col -- #2"',
+    "$$ -- #2 $$",
+    "$body$ it's -- #2 $body$",
+    "E'it\\'s -- #2'",
+    "e'back\\\\slash' || E'-- #2'",
+])
+def test_marker_inside_literal_is_ignored(literal):
+    text = f"-- #1\nSELECT {literal};\n-- #2\nSELECT 2;"
+    assert split_submission(text) == [(1, f"SELECT {literal};"), (2, "SELECT 2;")]
+
+
+def test_escape_string_spanning_lines():
+    text = "-- #1\nSELECT E'first\\'\n-- #2\n';\n-- #2\nSELECT 2;"
+    assert split_submission(text) == [(1, "SELECT E'first\\'\n-- #2\n';"), (2, "SELECT 2;")]
+
+
+def test_identifier_ending_in_e_is_not_an_escape_prefix():
+    text = "-- #1\nSELECT name'\\' FROM t;\n-- #2\nSELECT 2;"
+    assert split_submission(text) == [(1, "SELECT name'\\' FROM t;"), (2, "SELECT 2;")]
+
+
+def test_nested_block_comments_hide_markers():
+    text = "-- #1\nSELECT 1 /* outer /* inner */\n-- #2\n*/ + 1;\n-- #2\nSELECT 2;"
+    assert split_submission(text) == [(1, "SELECT 1 /* outer /* inner */\n-- #2\n*/ + 1;"), (2, "SELECT 2;")]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_chunk_boundaries_do_not_change_result(size):
+    text = (
+        "-- #1\nSELECT 'a -- #9', $t$ x $t$ FROM t; -- note\n"
+        "/* block\n-- #8 */\n-- #2\nSELECT E'\\'' AS q;\n"
+        "-- #3\nSELECT \"col\" FROM u"
+    )
+    assert split_in_chunks(text, size) == split_submission(text)
+    assert [question for question, _ in split_submission(text)] == [1, 2, 3]
+
+
+def test_feed_returns_questions_as_soon_as_they_complete():
+    splitter = SubmissionSplitter("dash")
+    assert splitter.feed("-- #1\nSELECT 1;\n") == []
+    assert splitter.feed("-- #2\n") == [(1, "SELECT 1;")]
+    assert splitter.feed("SELECT 2;") == []
+    assert splitter.close() == [(2, "SELECT 2;")]
+
+
+@pytest.mark.parametrize("text, duplicates", [
+    ("SELECT a;\n-- #1\nSELECT b;", [1]),
+    ("-- #1\nSELECT a;\n-- #2\nSELECT b;\n-- #1\nSELECT c;\n-- #2\nSELECT d;", [1, 2]),
+    ("-- #1\nSELECT a;\n-- #2\nSELECT b;", []),
+    ("-- #1\nSELECT '-- #1';", []),
+])
+def test_duplicate_question_numbers(text, duplicates):
+    assert duplicate_question_numbers(split_submission(text)) == duplicates